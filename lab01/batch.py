@@ -0,0 +1,141 @@
+"""
+Applying one filter to many frames (e.g. the images in a lab 6 file
+sequence), in parallel worker processes.
+
+The filter is sent to the workers as its description (the `spec`s of its
+filters, see lab.filter_from_spec) and rebuilt once per worker, so kernels,
+lookup tables and cascade optimizations are prepared once rather than for
+every frame.  Frames travel to and from the workers as compact bytes.  At most
+max_in_flight frames are being worked on at once, and results are yielded in
+the same order as the frames.
+
+Example:
+    blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5))
+    for result in process_frames(blur, frames_from_files(files)):
+        ...
+"""
+
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import lab
+from cache import pack_image, unpack_image
+
+
+# filters rebuilt from their specs in this (worker) process, by spec
+prepared_filters = {}
+
+
+def filter_specs(filt):
+    """
+    Returns a tuple of the specs of the given filter (or list of filters, to
+    be applied in order), or None if some filter has no spec
+    """
+    filters = filt if isinstance(filt, (list, tuple)) else [filt]
+    specs = tuple(getattr(f, 'spec', None) for f in filters)
+    return None if None in specs else specs
+
+
+def prepared_filter(specs):
+    """
+    Returns the filter described by the given specs, building it only the
+    first time it is needed in this process
+    """
+    filt = prepared_filters.get(specs)
+    if filt is None:
+        filt = lab.filter_cascade([lab.filter_from_spec(spec) for spec in specs])
+        prepared_filters[specs] = filt
+    return filt
+
+
+def filter_packed_frame(specs, entry):
+    """
+    Runs in a worker process: applies the filter described by specs to a
+    frame packed with cache.pack_image, and returns the packed result
+    """
+    frame = unpack_image(entry, {'pixels': bytearray()})
+    return pack_image(prepared_filter(specs)(frame))
+
+
+def decode_frame(data, color=True, compact=False):
+    """
+    Decodes an image file held in memory (bytes, e.g. one of the files from
+    lab 6's files_from_sequence) into an image, as load_color_image (or
+    load_greyscale_image if color is False) would load it from disk
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if color:
+            pixels = lab.ColorPixels(img.convert('RGB').tobytes())
+        else:
+            pixels = lab.greyscale_bytes_from_image(img)
+        width, height = img.size
+    image = {'height': height, 'width': width, 'pixels': pixels}
+    return image if compact else lab.expand_image(image)
+
+
+def frames_from_files(files, color=True, compact=False):
+    """
+    Given an iterable of image files held in memory, yields the decoded
+    images (see decode_frame)
+    """
+    for data in files:
+        yield decode_frame(data, color, compact)
+
+
+def process_frames(filt, frames, workers=None, max_in_flight=None, executor=None):
+    """
+    Applies a filter to each of the given frames, yielding the results in
+    order.
+
+    Parameters:
+      * filt (function or list) : a filter, or a list of filters to apply in
+            order, as given to lab.filter_cascade
+      * frames (iterable) : images (with list or compact pixels); they are
+            read only as needed
+      * workers (int) : the number of worker processes (defaults to the
+            number of CPUs); with 1 (or filters without a `spec`, which
+            cannot be sent to other processes) frames are filtered here
+      * max_in_flight (int) : the most frames read but not yet yielded
+            (defaults to twice the number of workers)
+      * executor (ProcessPoolExecutor) : an existing pool to use
+    Yields:
+      The filtered frames, with the same kind of pixels as the input frames
+    """
+    specs = filter_specs(filt)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if specs is None or (workers <= 1 and executor is None):
+        if specs is not None:
+            single = prepared_filter(specs)
+        elif isinstance(filt, (list, tuple)):
+            single = lab.filter_cascade(list(filt))
+        else:
+            single = filt
+        for frame in frames:
+            yield single(frame)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2*workers
+    pool = executor if executor is not None else ProcessPoolExecutor(max_workers=workers)
+    # (future, an empty image with the frame's kind of pixels) per frame
+    pending = deque()
+    try:
+        for frame in frames:
+            like = {'pixels': [] if isinstance(frame['pixels'], list) else bytearray()}
+            pending.append((pool.submit(filter_packed_frame, specs, pack_image(frame)), like))
+            if len(pending) >= max_in_flight:
+                future, like = pending.popleft()
+                yield unpack_image(future.result(), like)
+        while pending:
+            future, like = pending.popleft()
+            yield unpack_image(future.result(), like)
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        if executor is None:
+            pool.shutdown()
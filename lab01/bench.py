@@ -0,0 +1,257 @@
+"""
+Throughput benchmarks for the lab's filters, with regression tracking.
+
+Each benchmark applies one operation (a filter or a cascade of filters) to
+one image: every image in test_images/, loaded as greyscale or color to suit
+the operation, and synthetic images of a given number of megapixels.  For
+each one it reports the best time over a few runs as megapixels per second,
+and the peak resident memory (RSS) of the process.  Every benchmark runs in a
+fresh process, so the peak RSS belongs to that operation alone.
+
+Results are written as JSON.  Given a baseline (a results file saved from an
+earlier run), benchmarks whose throughput dropped, or whose peak memory grew,
+by more than a tolerance are reported as regressions.
+
+Run from this directory, for example:
+    python bench.py --output before.json
+    python bench.py --sizes 1 10 50 --only 'blurred_*' --baseline before.json
+"""
+
+import argparse
+import fnmatch
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import lab
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+TEST_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BLUR_SIZES = (3, 5, 9, 15, 25, 51)
+SHARPEN_SIZES = (3, 11)
+GAUSSIAN_SIGMAS = (1.5, 20)
+SYNTHETIC_SIZES = (1, 10, 50)
+
+
+def grey(filt):
+    return filt, False
+
+
+def color(filt):
+    return filt, True
+
+
+def operations():
+    """
+    Returns a dictionary mapping the name of each benchmarked operation to a
+    tuple (filter, color), where color is True if the filter takes color
+    images
+    """
+    ops = {'inverted': grey(lab.inverted), 'edges': grey(lab.edges)}
+    for n in BLUR_SIZES:
+        ops['blurred_%d' % n] = grey(lab.make_blur_filter(n))
+    for n in SHARPEN_SIZES:
+        ops['sharpened_%d' % n] = grey(lab.make_sharpen_filter(n))
+    for sigma in GAUSSIAN_SIGMAS:
+        ops['gaussian_%g' % sigma] = grey(lab.make_gaussian_filter(sigma))
+
+    color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
+    color_blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5))
+    ops['color_inverted'] = color(lab.color_filter_from_greyscale_filter(lab.inverted))
+    ops['color_blurred_9'] = color(lab.color_filter_from_greyscale_filter(lab.make_blur_filter(9)))
+    ops['color_sharpened_7'] = color(lab.color_filter_from_greyscale_filter(lab.make_sharpen_filter(7)))
+    ops['color_edges'] = color(color_edges)
+    ops['color_scale'] = color(lab.color_scale_filter(1.2, 0.8, 1))
+    ops['cascade_edges_blur'] = color(lab.filter_cascade(
+        [color_edges, color_edges, color_blur, color_edges]))
+    ops['cascade_point_blurs'] = grey(lab.filter_cascade(
+        [lab.inverted, lab.make_blur_filter(3), lab.make_blur_filter(5),
+         lab.make_sharpen_filter(3)]))
+    return ops
+
+
+def synthetic_image(megapixels, color=False, compact=False, seed=0):
+    """
+    Returns a reproducible image of random pixels with about the given number
+    of megapixels, in a 4:3 aspect ratio
+    """
+    width = max(1, round(math.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = max(1, round(megapixels * 1e6 / width))
+    data = random.Random(seed).randbytes(width*height*(3 if color else 1))
+    pixels = lab.ColorPixels(data) if color else bytearray(data)
+    image = {'height': height, 'width': width, 'pixels': pixels}
+    return image if compact else lab.expand_image(image)
+
+
+def load_image(source, color, compact):
+    """
+    Returns the image described by source: the name of a file in
+    test_images/, or 'synthetic_<n>mp'
+    """
+    if source.startswith('synthetic_'):
+        return synthetic_image(float(source[len('synthetic_'):-len('mp')]),
+                               color, compact)
+    filename = os.path.join(TEST_DIRECTORY, 'test_images', source)
+    if color:
+        return lab.load_color_image(filename, compact)
+    return lab.load_greyscale_image(filename, compact)
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process so far, in megabytes,
+    or None if it cannot be measured on this platform
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def run_case(case):
+    """
+    Runs one benchmark, given as a tuple (operation, source, repeat,
+    compact, use_numpy), and returns its measurements as a dictionary
+    """
+    op_name, source, repeat, compact, use_numpy = case
+    if use_numpy:
+        import numpy_backend
+        numpy_backend.enable()
+    filt, is_color = operations()[op_name]
+    image = load_image(source, is_color, compact)
+    input_rss = peak_rss()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        filt(image)
+        times.append(time.perf_counter() - start)
+    megapixels = image['width'] * image['height'] / 1e6
+    return {'operation': op_name, 'image': source,
+            'megapixels': megapixels, 'seconds': min(times),
+            'mp_per_s': megapixels / max(min(times), 1e-9),
+            'input_rss_mb': input_rss, 'peak_rss_mb': peak_rss()}
+
+
+def benchmark_cases(only=None, images=None, sizes=SYNTHETIC_SIZES):
+    """
+    Returns a list of (operation name, image source) pairs to benchmark.
+    only and images are lists of shell-style patterns that operation names
+    and image file names must match (all of them if None).
+    """
+    names = sorted(name for name in os.listdir(os.path.join(TEST_DIRECTORY, 'test_images'))
+                   if name.endswith('.png'))
+    if images is not None:
+        names = [name for name in names
+                 if any(fnmatch.fnmatch(name, pattern) for pattern in images)]
+    sources = names + ['synthetic_%gmp' % size for size in sizes]
+    ops = [name for name in operations()
+           if only is None or any(fnmatch.fnmatch(name, pattern) for pattern in only)]
+    return [(op, source) for op in ops for source in sources]
+
+
+def run_benchmarks(cases, repeat=3, compact=False, use_numpy=False,
+                   isolate=True, report=None):
+    """
+    Runs the given (operation, image) benchmarks and returns a results
+    dictionary ready to be saved as JSON.  With isolate (the default), each
+    benchmark runs in its own fresh process.  report, if given, is called
+    with each benchmark's measurements as soon as it finishes.
+    """
+    results = {}
+    for op_name, source in cases:
+        case = (op_name, source, repeat, compact, use_numpy)
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                measured = pool.submit(run_case, case).result()
+        else:
+            measured = run_case(case)
+        results['%s@%s' % (op_name, source)] = measured
+        if report is not None:
+            report(measured)
+    return {'machine': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'processor': platform.processor(),
+                        'numpy': use_numpy, 'compact': compact},
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}
+
+
+def find_regressions(results, baseline, tolerance=0.1):
+    """
+    Compares results with a baseline (both as returned by run_benchmarks),
+    returning a list of (benchmark, what, baseline value, new value) for
+    every benchmark whose throughput fell, or whose peak memory rose, by more
+    than the given fraction.  Benchmarks missing from either are ignored.
+    """
+    regressions = []
+    for key, new in sorted(results['results'].items()):
+        old = baseline['results'].get(key)
+        if old is None:
+            continue
+        if new['mp_per_s'] < old['mp_per_s'] * (1 - tolerance):
+            regressions.append((key, 'mp_per_s', old['mp_per_s'], new['mp_per_s']))
+        if (new['peak_rss_mb'] is not None and old['peak_rss_mb'] is not None
+                and new['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance)):
+            regressions.append((key, 'peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb']))
+    return regressions
+
+
+def print_measurement(measured):
+    rss = measured['peak_rss_mb']
+    print('%-22s %-26s %8.2f MP %10.3f MP/s %9s' % (
+        measured['operation'], measured['image'], measured['megapixels'],
+        measured['mp_per_s'], '-' if rss is None else '%.0f MB' % rss))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--only', nargs='+', metavar='PATTERN',
+                        help='operations to run, e.g. "blurred_*" (default: all)')
+    parser.add_argument('--images', nargs='+', metavar='PATTERN',
+                        help='files in test_images/ to use (default: all)')
+    parser.add_argument('--sizes', nargs='*', type=float, default=list(SYNTHETIC_SIZES),
+                        metavar='MP', help='sizes of the synthetic images, in megapixels')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compact', action='store_true',
+                        help='use compact pixel buffers instead of lists')
+    parser.add_argument('--numpy', action='store_true',
+                        help='use the NumPy backend (numpy_backend.py)')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fractional slowdown or memory growth allowed')
+    args = parser.parse_args(argv)
+
+    cases = benchmark_cases(args.only, args.images, args.sizes)
+    results = run_benchmarks(cases, args.repeat, args.compact, args.numpy,
+                             report=print_measurement)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for key, what, old, new in regressions:
+        print('REGRESSION %s: %s %.3f -> %.3f' % (key, what, old, new))
+    if not regressions:
+        print('No regressions against %s' % args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
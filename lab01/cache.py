@@ -0,0 +1,224 @@
+"""
+A content-addressed cache of filter results, in memory and on disk.
+
+Results are keyed by a hash of the input image's contents together with the
+descriptions (`spec`s, see lab.filter_from_spec) of the filters applied to
+it, so the same filters applied to an identical image are only computed
+once, however the image was loaded or whichever filter objects are used.
+
+Cascades cache the result of every stage: a cascade that starts with the same
+filters as an earlier one resumes from the longest cached prefix.  Filters
+without a `spec` cannot be described, so a cascade is only cached up to its
+first such filter.
+
+Example:
+    results = FilterCache('filter_cache')
+    blur = results.cached(lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5)))
+    cascade = results.filter_cascade([lab.color_filter_from_greyscale_filter(lab.edges), blur])
+"""
+
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import lab
+
+
+def image_data(image):
+    """
+    Returns the pixels of the given image as a tuple (kind, data): ('L',
+    bytes) for greyscale pixels in [0, 255], ('RGB', bytes) for color pixels,
+    or ('values', list) for anything else.  The result is the same for list
+    and compact pixels holding the same values.
+    """
+    pixels = image['pixels']
+    data = lab.pixel_bytes(pixels)
+    if data is not None:
+        return 'L', bytes(data)
+    try:
+        colors = lab.compact_pixels(pixels)
+    except (TypeError, ValueError):
+        colors = None
+    if isinstance(colors, lab.ColorPixels):
+        return 'RGB', bytes(colors.data)
+    return 'values', list(pixels)
+
+
+def image_digest(image):
+    """
+    Returns a hash (bytes) of the size and pixel values of the given image
+    """
+    kind, data = image_data(image)
+    if kind == 'values':
+        data = repr(data).encode()
+    digest = hashlib.sha256(b'%d,%d,%s;' % (image['width'], image['height'],
+                                            kind.encode()))
+    digest.update(data)
+    return digest.digest()
+
+
+def pack_image(image):
+    """
+    Returns a picklable tuple holding the given image as compactly as
+    possible, to be stored in the cache
+    """
+    return image['height'], image['width'], image_data(image)
+
+
+def unpack_image(entry, like):
+    """
+    Rebuilds a new image from a tuple made by pack_image, with the same kind
+    of pixel container (list or compact) as the image `like`
+    """
+    height, width, (kind, data) = entry
+    if kind == 'RGB':
+        pixels = lab.ColorPixels(data)
+    elif kind == 'L':
+        pixels = bytearray(data)
+    else:
+        pixels = lab.compact_pixels(data)
+    image = {'height': height, 'width': width, 'pixels': pixels}
+    if isinstance(like['pixels'], list):
+        image = lab.expand_image(image)
+    return image
+
+
+def entry_size(entry):
+    """
+    Returns the approximate number of bytes of memory taken by a cache entry
+    """
+    kind, data = entry[2]
+    return len(data) if kind != 'values' else 8*len(data)
+
+
+class FilterCache:
+    """
+    Caches the results of applying filters to images.
+
+    Parameters:
+      * directory (str) : where results are also stored on disk (one pickle
+            file per result), or None to only cache in memory
+      * max_bytes (int) : roughly how much pixel data to keep in memory; the
+            least recently used results are dropped first
+    """
+    def __init__(self, directory=None, max_bytes=256*2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, digest, specs):
+        """
+        Returns the cache key for the image with the given digest after the
+        filters with the given specs have been applied to it
+        """
+        return hashlib.sha256(digest + repr(tuple(specs)).encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Returns the name of the file that stores the result with the given key
+        """
+        return os.path.join(self.directory, key + '.pickle')
+
+    def remember(self, key, entry):
+        """
+        Adds an entry to the in-memory LRU cache, dropping old entries to
+        stay within max_bytes
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = entry
+        self.memory_bytes += entry_size(entry)
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_bytes -= entry_size(dropped)
+
+    def lookup(self, key):
+        """
+        Returns the entry stored under key, or None if it is not cached
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is not None:
+            try:
+                with open(self.path(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+            self.remember(key, entry)
+            return entry
+        return None
+
+    def store(self, key, image):
+        """
+        Stores an image under key, in memory and on disk
+        """
+        entry = pack_image(image)
+        self.remember(key, entry)
+        if self.directory is not None:
+            # write to a temporary file first so that readers never see a
+            # partially written result
+            temporary = self.path(key) + '.%d.tmp' % os.getpid()
+            with open(temporary, 'wb') as f:
+                pickle.dump(entry, f)
+            os.replace(temporary, self.path(key))
+
+    def apply(self, filters, image):
+        """
+        Applies the given filters, in order, to the given image, reusing the
+        cached result of the longest prefix of the filters that has already
+        been applied to an image with the same contents
+        """
+        specs = []
+        for filt in filters:
+            spec = getattr(filt, 'spec', None)
+            if spec is None:
+                break
+            specs.append(spec)
+
+        digest = image_digest(image)
+        result = image
+        done = 0
+        for prefix in range(len(specs), 0, -1):
+            entry = self.lookup(self.key(digest, specs[:prefix]))
+            if entry is not None:
+                result = unpack_image(entry, image)
+                done = prefix
+                break
+        if done == len(filters) and done:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        for i in range(done, len(filters)):
+            result = filters[i](result)
+            if i < len(specs):
+                self.store(self.key(digest, specs[:i+1]), result)
+        return result
+
+    def cached(self, filt):
+        """
+        Returns a version of the given filter (e.g. one made by
+        lab.color_filter_from_greyscale_filter) whose results are cached
+        """
+        def cached_filter(image):
+            return self.apply([filt], image)
+        if hasattr(filt, 'spec'):
+            cached_filter.spec = filt.spec
+        return cached_filter
+
+    def filter_cascade(self, filters):
+        """
+        Cached version of lab.filter_cascade: returns a filter that applies
+        the given filters in order, caching the result of every stage
+        """
+        filters = list(filters)
+        def all_filter(image):
+            return self.apply(filters, image)
+        return all_filter
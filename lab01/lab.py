@@ -6,6 +6,24 @@ from PIL import Image as Image
 
 # NO ADDITIONAL IMPORTS ALLOWED!
 
+# module providing whole-array versions of the basic image operations (see
+# set_backend), or None to use the pure-Python code in this file
+backend = None
+
+def set_backend(new_backend):
+    """
+    Selects where inverted, scaled, correlate, round_and_clip_image, edges,
+    split_to_grayscale and merge_to_color do their work.
+
+    Parameters:
+      * new_backend (module) : a module defining functions with those names
+            that produce the same results as the ones in this file (e.g.
+            numpy_backend, enabled with numpy_backend.enable()), or None to
+            go back to the pure-Python code
+    """
+    global backend
+    backend = new_backend
+
 def get_width(image):
     """
     Extracts the width from the given image
@@ -73,6 +91,10 @@ def apply_per_pixel(image, func):
     Returns:
       A new image with the function applied
     """
+    if not isinstance(image['pixels'], list):
+        # compact images get a new buffer suited to the new values
+        return pixel_list_to_img(image, [func(color) for color in image['pixels']])
+
     result = {'height': image['height'],
             'width': image['width'],
             'pixels': image['pixels'][:]
@@ -89,14 +111,78 @@ def inverted(image):
     """
     Reverses the grayscale value of each pixel
     """
+    if backend is not None:
+        return backend.inverted(image)
+
+    # pixels in the range [0, 255] are mapped in one pass through a table
+    result = apply_lut(image, INVERTED_LUT)
+    if result is not None:
+        return result
     return apply_per_pixel(image, lambda c: 255-c)
+inverted.spec = ('invert',)
 
 def scaled(image, n):
     """
     Multiplies the grayscale value of each pixel by n
     """
+    if backend is not None:
+        return backend.scaled(image, n)
+
     return apply_per_pixel(image, lambda c: c*n)
 
+# LOOKUP TABLES
+
+def clipped_scale_lut(n):
+    """
+    Returns a 256-entry lookup table giving, for each pixel value c in the
+    range [0, 255], the value of c*n rounded and clipped to [0, 255] (as
+    round_and_clip_image(scaled(image, n)) would)
+    """
+    return bytes(min(255, max(0, round(c*n))) for c in range(256))
+
+INVERTED_LUT = bytes(255-c for c in range(256))
+
+# SOBEL_MAGNITUDES[s] is min(255, round(math.sqrt(s))) for each integer s below
+# 255**2 (larger squared magnitudes all clip to 255).  round(math.sqrt(s)) is k
+# exactly for the 2k integers k*k-k < s <= k*k+k, since no integer comes within
+# a quarter of (k+0.5)**2.
+SOBEL_MAGNITUDES = bytes(k for k in range(256) for _ in range(2*k or 1))[:255*255]
+
+def pixel_bytes(pixels):
+    """
+    Returns the given grayscale pixels as a bytes-like object if they are all
+    integers in the range [0, 255], or None otherwise
+    """
+    if isinstance(pixels, (bytes, bytearray)):
+        return pixels
+    if not isinstance(pixels, list):
+        return None
+    try:
+        return bytes(pixels)
+    except (TypeError, ValueError):
+        return None
+
+def apply_lut(image, lut):
+    """
+    Returns a new grayscale image in which each pixel value c of the given
+    image is replaced with lut[c], using bytes.translate so that the whole
+    image is mapped in a single pass, or None if the image has pixels that
+    are not integers in the range [0, 255]
+
+    Parameters:
+      * image (dict) : a grayscale image
+      * lut (bytes or list) : 256 integers in the range [0, 255]
+    """
+    data = pixel_bytes(image['pixels'])
+    if data is None:
+        return None
+    mapped = data.translate(bytes(lut))
+    if isinstance(image['pixels'], list):
+        mapped = list(mapped)
+    else:
+        mapped = bytearray(mapped)
+    return {'height': image['height'], 'width': image['width'], 'pixels': mapped}
+
 def get_pixel_new(image, x, y, boundary_behavior=None):
     """
     Modified version of get_pixel that includes settings for various boundary
@@ -142,11 +228,606 @@ def get_pixel_new(image, x, y, boundary_behavior=None):
 def pixel_list_to_img(image, pix_lst):
     """
     Converts list of pixels to image dictionary
+
+    If the given image is compact (see compact_image), the new pixels are
+    packed into a compact buffer as well.
     """
+    if not isinstance(image['pixels'], list):
+        pix_lst = compact_pixels(pix_lst)
     return {'height': image['height'], 'width': image['width'], 'pixels': pix_lst}
 
+# COMPACT IMAGES
+
+class ColorPixels:
+    """
+    Compact storage for the pixels of a color image: 3 bytes per pixel in a
+    single interleaved bytearray (r, g, b, r, g, b, ...), indexed as (r, g, b)
+    tuples so that it can stand in for a list of tuples.
+    """
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+
+    def __len__(self):
+        return len(self.data) // 3
+
+    def pixel_index(self, index):
+        """
+        Returns the non-negative position of the pixel at the given (possibly
+        negative) index, raising IndexError like a list would
+        """
+        size = len(self)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('ColorPixels index out of range')
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return ColorPixels(self.data[3*start:3*stop])
+            return ColorPixels(b''.join(bytes(self[i]) for i in
+                                        range(start, stop, step)))
+        index = self.pixel_index(index)
+        return tuple(self.data[3*index:3*index+3])
+
+    def __setitem__(self, index, color):
+        index = self.pixel_index(index)
+        self.data[3*index:3*index+3] = bytes(color)
+
+    def __iter__(self):
+        data = self.data
+        return zip(data[0::3], data[1::3], data[2::3])
+
+    def __eq__(self, other):
+        if isinstance(other, ColorPixels):
+            return self.data == other.data
+        return NotImplemented
+
+    def __repr__(self):
+        return 'ColorPixels(%r)' % bytes(self.data)
+
+class NumberPixels:
+    """
+    Compact storage for pixel values that do not fit in a bytearray, such as
+    the unclipped output of correlate: 8 bytes per value in a bytearray,
+    holding 64-bit integers (typecode 'q') if every value is an integer, or
+    floats (typecode 'd') otherwise, indexed like a list of numbers.
+    """
+    def __init__(self, data=b'', typecode='d'):
+        self.data = bytearray(data)
+        self.typecode = typecode
+        # the bytes of data, read and written as numbers
+        self.values = memoryview(self.data).cast(typecode)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return NumberPixels(self.values[index].tobytes(), self.typecode)
+        return self.values[index]
+
+    def __setitem__(self, index, value):
+        try:
+            self.values[index] = value
+        except (TypeError, ValueError):
+            # a float among integers: store every value as a float
+            values = self.values.tolist()
+            values[index] = value
+            self.__init__(float_pixels(values).data, 'd')
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __eq__(self, other):
+        if isinstance(other, NumberPixels):
+            return self.values.tolist() == other.values.tolist()
+        return NotImplemented
+
+    def __reduce__(self):
+        # memoryviews cannot be pickled, so rebuild from the bytes
+        return NumberPixels, (bytes(self.data), self.typecode)
+
+    def __repr__(self):
+        return 'NumberPixels(%r, %r)' % (bytes(self.data), self.typecode)
+
+def float_pixels(values):
+    """
+    Packs a sequence of numbers into a NumberPixels buffer of 8-byte floats,
+    for unclipped results such as the output of correlate
+    """
+    values = list(values)
+    pixels = NumberPixels(bytes(8*len(values)), 'd')
+    buffer = pixels.values
+    for i, value in enumerate(values):
+        buffer[i] = value
+    return pixels
+
+def integer_pixels(values):
+    """
+    Packs a sequence of integers into a NumberPixels buffer of 64-bit
+    integers, or returns None if some value does not fit in one
+    """
+    values = list(values)
+    pixels = NumberPixels(bytes(8*len(values)), 'q')
+    buffer = pixels.values
+    try:
+        for i, value in enumerate(values):
+            buffer[i] = value
+    except ValueError:
+        return None
+    return pixels
+
+def compact_pixels(values):
+    """
+    Packs a sequence of pixel values into the smallest compact buffer that
+    holds them exactly:
+      * (r, g, b) tuples : a ColorPixels (3 bytes per pixel)
+      * integers in the range [0, 255] : a bytearray (1 byte per pixel)
+      * other integers : a NumberPixels of integers (8 bytes per pixel)
+      * any other numbers : a NumberPixels of floats (8 bytes per pixel)
+    Integers too large for 64 bits are kept in a list.
+    """
+    if isinstance(values, (bytearray, ColorPixels, NumberPixels)):
+        return values
+    values = list(values)
+    if values and isinstance(values[0], tuple):
+        data = bytearray(3*len(values))
+        for channel in range(3):
+            data[channel::3] = bytes([color[channel] for color in values])
+        return ColorPixels(data)
+    try:
+        return bytearray(values)
+    except (TypeError, ValueError):
+        pass
+    if all(isinstance(value, int) for value in values):
+        pixels = integer_pixels(values)
+        return values if pixels is None else pixels
+    return float_pixels(values)
+
+def compact_image(image):
+    """
+    Returns a copy of the given image whose pixels are stored in a compact
+    buffer (see compact_pixels) instead of a list of Python objects, so a
+    greyscale pixel takes 1 byte and a color pixel 3 bytes instead of
+    ~28-80 bytes.
+
+    Compact images work with get_pixel, set_pixel, apply_per_pixel, all of
+    the filters, and the save functions, and the results of filtering a
+    compact image are compact as well.
+    """
+    pixels = image['pixels']
+    if isinstance(pixels, list):
+        pixels = compact_pixels(pixels)
+    else:
+        pixels = pixels[:]
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+def expand_image(image):
+    """
+    Returns a copy of the given (possibly compact) image whose pixels are
+    stored in a list, as ints, floats, or (r, g, b) tuples
+    """
+    return {'height': image['height'], 'width': image['width'],
+            'pixels': list(image['pixels'])}
+
 # HELPER FUNCTIONS
 
+def boundary_index(i, size, boundary_behavior):
+    """
+    Maps a (possibly out-of-bounds) index along one axis of an image to the
+    in-bounds index whose value should be used in its place
+
+    Parameters:
+      * i (int) : the index along the axis
+      * size (int) : the length of the axis
+      * boundary_behavior (string) : 'zero', 'extend', or 'wrap' (see
+            get_pixel_new)
+    Returns:
+      An in-bounds index, or None if the pixel should be treated as 0
+    """
+    if 0 <= i < size:
+        return i
+    if boundary_behavior == "zero":
+        return None
+    if boundary_behavior == "extend":
+        return 0 if i < 0 else size-1
+    return i % size
+
+def divide_exact(a, b):
+    """
+    Divides a by b, keeping the result an integer when both are integers and
+    b divides a evenly
+    """
+    if isinstance(a, int) and isinstance(b, int) and a % b == 0:
+        return a // b
+    return a / b
+
+def separate_kernel(kernel):
+    """
+    Splits a rank-1 (separable) kernel into a column and a row such that
+    kernel[y][x] == column[y] * row[x] for every entry of the kernel.
+
+    Every kernel made by create_blur_kernel is separable, as are both Sobel
+    kernels used by edges.
+
+    Parameters:
+      * kernel (list) : a 2D list, where each nested list is a row
+    Returns:
+      A tuple (column, row) of 1D lists, or None if the kernel is not
+      separable (or is all zeros)
+    """
+    pivot = None
+    for kern_y, kern_row in enumerate(kernel):
+        for kern_x, scale_factor in enumerate(kern_row):
+            if scale_factor != 0:
+                pivot = (kern_y, kern_x)
+                break
+        if pivot is not None:
+            break
+    if pivot is None:
+        return None
+
+    pivot_y, pivot_x = pivot
+    divisor = kernel[pivot_y][pivot_x]
+    if all(isinstance(scale_factor, int) for scale_factor in kernel[pivot_y]):
+        # dividing integer kernels by the gcd of the row keeps both factors
+        # integers, so integer images stay exact
+        divisor = math.gcd(*kernel[pivot_y]) * (1 if divisor > 0 else -1)
+    row = [divide_exact(scale_factor, divisor)
+           for scale_factor in kernel[pivot_y]]
+    column = [divide_exact(kern_row[pivot_x], row[pivot_x]) for kern_row in kernel]
+
+    # only use the factors if they reproduce every entry exactly
+    for kern_row, column_factor in zip(kernel, column):
+        if len(kern_row) != len(row):
+            return None
+        for scale_factor, row_factor in zip(kern_row, row):
+            if column_factor*row_factor != scale_factor:
+                return None
+    return column, row
+
+def weight_denominator(weights):
+    """
+    Returns the smallest power of two D such that D times each of the given
+    weights is an integer (every finite float is such a fraction), or None if
+    some weight is not an int or a finite float
+    """
+    denominator = 1
+    for weight in weights:
+        if isinstance(weight, float) and math.isfinite(weight):
+            denominator = max(denominator, weight.as_integer_ratio()[1])
+        elif not isinstance(weight, int):
+            return None
+    return denominator
+
+def integer_magnitude(pixels):
+    """
+    Returns the largest absolute value of the given pixels if they are all
+    integers, or None otherwise
+    """
+    if pixel_bytes(pixels) is not None:
+        return 255
+    if not all(isinstance(pix, int) for pix in pixels):
+        return None
+    return max((abs(pix) for pix in pixels), default=0)
+
+def exact_separable_factors(kernel, largest):
+    """
+    Returns the factors of the given kernel (see separate_kernel) if the two
+    1D passes of correlate_separable give exactly the same sums as the 2D
+    kernel for integer pixels of magnitude at most largest, or None.
+
+    With each factor scaled by the power of two from weight_denominator,
+    every product and partial sum of either computation is an integer
+    multiple of 1/(column denominator * row denominator).  If those integers
+    stay below 2**53, none of the float additions round, so the order in
+    which the terms are added does not matter.  That holds for integer
+    kernels and for weights like 1/16, but not for weights like 1/36, whose
+    sums round differently in the two orders.
+    """
+    factors = separate_kernel(kernel)
+    if factors is None or largest is None:
+        return None
+    bound = largest
+    for factor in factors:
+        denominator = weight_denominator(factor)
+        if denominator is None:
+            return None
+        bound *= sum(abs(weight)*denominator for weight in factor)
+    return factors if bound < 2**53 else None
+
+def pad_image(image, top, bottom, left, right, boundary_behavior):
+    """
+    Builds a copy of the image with extra rows and columns around it, filled
+    in according to the given boundary behavior, so that a kernel can read
+    every pixel it needs without any bounds checks.
+
+    Parameters:
+      * image (dict) : contains the height, width, and a 1D
+            list of pixels of an image
+      * top, bottom, left, right (int) : the number of pixels to add on
+            each side
+      * boundary_behavior (string) : 'zero', 'extend', or 'wrap' (see
+            get_pixel_new)
+    Returns:
+      A list of top+height+bottom rows, each a list of left+width+right
+      pixel values
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+
+    x_indices = [boundary_index(x, width, boundary_behavior)
+                 for x in range(-left, width + right)]
+    zero_row = [0]*len(x_indices)
+
+    padded = []
+    for y in range(-top, height + bottom):
+        source_y = boundary_index(y, height, boundary_behavior)
+        if source_y is None:
+            padded.append(zero_row)
+            continue
+        pixel_row = pixels[source_y*width:(source_y+1)*width]
+        padded.append([pixel_row[x] if x is not None else 0
+                       for x in x_indices])
+    return padded
+
+def correlate_separable(image, column, row, boundary_behavior):
+    """
+    Correlates the given image with the kernel column[y] * row[x] by running
+    two 1D passes: first along each row of the image with `row`, then along
+    each column of the intermediate result with `column`.
+
+    Costs len(row) + len(column) multiplications per pixel instead of
+    len(row) * len(column).  The terms are added in a different order from
+    the full 2D kernel, so correlate only uses this for the factors from
+    exact_separable_factors, for which the output is the same under each of
+    the 'zero', 'extend', and 'wrap' boundary behaviors.
+    """
+    width = image['width']
+    height = image['height']
+
+    # horizontal pass: pad each row once according to the boundary behavior,
+    # then add up shifted copies of it
+    row_range = len(row) // 2
+    horizontal = []
+    for padded in pad_image(image, 0, 0, row_range, len(row) - row_range - 1,
+                            boundary_behavior):
+        row_sum = [0]*width
+        for kern_x, scale_factor in enumerate(row):
+            if scale_factor == 0:
+                continue
+            row_sum = [total + pix*scale_factor for total, pix in
+                       zip(row_sum, padded[kern_x:kern_x+width])]
+        horizontal.append(row_sum)
+
+    # vertical pass: add up scaled rows of the horizontal result, where rows
+    # treated as 0 ('zero' behavior) contribute nothing
+    column_range = len(column) // 2
+    y_indices = [boundary_index(y, height, boundary_behavior)
+                 for y in range(-column_range,
+                                height + len(column) - column_range - 1)]
+    new_img = []
+    for y in range(height):
+        column_sum = [0]*width
+        for kern_y, scale_factor in enumerate(column):
+            source_y = y_indices[y+kern_y]
+            if scale_factor == 0 or source_y is None:
+                continue
+            column_sum = [total + pix*scale_factor for total, pix in
+                          zip(column_sum, horizontal[source_y])]
+        new_img.extend(column_sum)
+
+    return pixel_list_to_img(image, new_img)
+
+def sliding_window_sums(vectors, n, boundary_behavior):
+    """
+    Computes running sums of n consecutive vectors, e.g. the rows of an image.
+
+    Output vector i is the elementwise sum of input vectors i-n//2 through
+    i+n-1-n//2 (the same window a length-n kernel covers in correlate), with
+    out-of-range positions handled according to boundary_behavior. Each step
+    adds the vector entering the window and subtracts the one leaving it, so
+    the cost does not depend on n.
+
+    Parameters:
+      * vectors (list) : a non-empty list of equal-length sequences of numbers
+      * n (int) : the size of the window
+      * boundary_behavior (string) : 'zero', 'extend', or 'wrap'
+    Returns:
+      A list of lists, one per input vector
+    """
+    k_range = n // 2
+    zero = [0]*len(vectors[0])
+    window = []
+    for i in range(-k_range, len(vectors) + n - k_range - 1):
+        source = boundary_index(i, len(vectors), boundary_behavior)
+        window.append(vectors[source] if source is not None else zero)
+
+    total = zero
+    for vector in window[:n]:
+        total = [t + v for t, v in zip(total, vector)]
+    sums = [total]
+    for i in range(len(vectors) - 1):
+        total = [t + entering - leaving for t, entering, leaving in
+                 zip(total, window[i+n], window[i])]
+        sums.append(total)
+    return sums
+
+def box_sums(image, n):
+    """
+    Computes the exact integer sums of the n-by-n box around each pixel of the
+    given image (using 'extend' behavior), with a cost per pixel that does not
+    depend on n.
+
+    Returns:
+      A list of rows holding the sum of the box around each pixel, or None if
+      the image has non-integer pixels (running sums of floats would
+      accumulate error)
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    if not pixels or not all(isinstance(pix, int) for pix in pixels):
+        return None
+
+    rows = [pixels[y*width:(y+1)*width] for y in range(height)]
+    # horizontal sums are computed on the transposed image, so both passes
+    # slide whole vectors at a time
+    row_sums = [list(row) for row in
+                zip(*sliding_window_sums(list(zip(*rows)), n, 'extend'))]
+    return sliding_window_sums(row_sums, n, 'extend')
+
+
+def repeated_box_sums(image, sizes):
+    """
+    Applies a running-sum box filter of each of the given sizes in turn to
+    the given image, first along the rows and then along the columns, without
+    dividing.  The image is padded once ('extend' behavior) by the combined
+    reach of all of the passes, so every pass sees the same pixels beyond the
+    edges that a single large kernel would.
+
+    Returns:
+      A list of rows of sums; dividing by the product of the squares of the
+      sizes gives the repeatedly box-blurred image.  The cost per pixel
+      depends only on the number of passes, not on their sizes.
+    """
+    width = image['width']
+    height = image['height']
+    pad = sum(n // 2 for n in sizes)
+    padded = pad_image(image, pad, pad, pad, pad, 'extend')
+    # as in box_sums, horizontal sums slide over the columns of the image;
+    # the padding absorbs the edge effects of each pass, and is cut off
+    columns = list(zip(*padded))
+    for n in sizes:
+        columns = sliding_window_sums(columns, n, 'extend')
+    rows = [list(row) for row in zip(*columns[pad:pad+width])]
+    for n in sizes:
+        rows = sliding_window_sums(rows, n, 'extend')
+    return rows[pad:pad+height]
+
+
+def is_box_tie(box_sum, area):
+    """
+    Returns True if box_sum/area has a fractional part of exactly .5
+    """
+    return area % 2 == 0 and box_sum % area == area // 2
+
+
+def tie_blur_value(image, x, y, n):
+    """
+    Recomputes the blurred value of pixel (x, y) by adding up the scaled
+    pixels of its box in the same (row-major) order as correlating with
+    create_blur_kernel(n), for the exact ties whose rounding depends on that
+    order
+    """
+    return correlate_pixels(image, create_blur_kernel(n), [(x, y)], 'extend')[0]
+
+
+def box_blur_values(image, n):
+    """
+    Computes the unrounded result of correlating the given image with
+    create_blur_kernel(n) using 'extend' behavior, with a cost per pixel that
+    does not depend on n.
+
+    Exact integer window sums are built with box_sums, so every value rounds
+    exactly as the output of correlate does.  The only values that depend on
+    floating-point summation order are exact ties (a fractional part of .5,
+    only possible for even n); those are recomputed in the same order
+    correlate uses so that round_and_clip_image gives bit-identical results.
+
+    Returns:
+      A list of pixel values, or None if the image has non-integer pixels
+    """
+    window_sums = box_sums(image, n)
+    if window_sums is None:
+        return None
+
+    area = n*n
+    values = []
+    for y, sum_row in enumerate(window_sums):
+        for x, box_sum in enumerate(sum_row):
+            if is_box_tie(box_sum, area):
+                values.append(tie_blur_value(image, x, y, n))
+            else:
+                values.append(box_sum/area)
+    return values
+
+
+def unsharp_values(image, n):
+    """
+    Computes the output of sharpened (2*pixel - box blur, rounded and
+    clipped) for an image with integer pixels in a single pass over the box
+    sums from box_sums.
+
+    2*pixel - box_sum/area is rounded as the exact fraction
+    (2*pixel*area - box_sum)/area using integer arithmetic, which gives the
+    same result as rounding the floats unless the fraction is an exact tie.
+    Ties happen exactly when the blur itself is a tie, and are recomputed
+    with tie_blur_value as the blurred image would have held them.
+
+    Returns:
+      A list of pixel values in the range [0, 255], or None if the image has
+      non-integer pixels
+    """
+    window_sums = box_sums(image, n)
+    if window_sums is None:
+        return None
+
+    width = image['width']
+    pixels = image['pixels']
+    area = n*n
+    values = []
+    for y, sum_row in enumerate(window_sums):
+        pixel_row = pixels[y*width:(y+1)*width]
+        # round((2*pixel*area - box_sum)/area), correct wherever it is not a tie
+        row_values = [(4*area*pixel - 2*box_sum + area) // (2*area)
+                      for pixel, box_sum in zip(pixel_row, sum_row)]
+        if area % 2 == 0:
+            for x, box_sum in enumerate(sum_row):
+                if is_box_tie(box_sum, area):
+                    row_values[x] = round(2*pixel_row[x] -
+                                          tie_blur_value(image, x, y, n))
+        values.extend([0 if value < 0 else 255 if value > 255 else value
+                       for value in row_values])
+    return values
+
+
+def sobel_magnitude_rows(image):
+    """
+    Computes the output of edges for an image with integer pixels in a single
+    pass, yielding one row of clipped magnitudes at a time.
+
+    Each row of the result only needs the rows above and below it.  Those are
+    combined column by column (above + 2*row + below for the x gradient,
+    below - above for the y gradient), so that both gradients of a pixel come
+    from a few additions of neighboring column values.  All of the gradient
+    arithmetic is on integers, so the results are exactly those of
+    correlating with the two Sobel kernels, and magnitudes are looked up in
+    SOBEL_MAGNITUDES instead of being rounded from a square root.
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    rows = [pixels[y*width:(y+1)*width] for y in range(height)]
+    # 'extend' padding of one column on each side
+    rows = [list(row[:1]) + list(row) + list(row[-1:]) for row in rows]
+    for y, row in enumerate(rows):
+        above = rows[max(0, y-1)]
+        below = rows[min(height-1, y+1)]
+        columns = [a + 2*m + b for a, m, b in zip(above, row, below)]
+        differences = [b - a for a, b in zip(above, below)]
+        squares = [gx*gx + gy*gy for gx, gy in
+                   zip([right - left for left, right in zip(columns, columns[2:])],
+                       [left + 2*mid + right for left, mid, right in
+                        zip(differences, differences[1:], differences[2:])])]
+        yield [SOBEL_MAGNITUDES[square] if square < 65025 else 255
+               for square in squares]
+
+
 def correlate(image, kernel, boundary_behavior):
     """
     Compute the result of correlating the given image with the given kernel.
@@ -167,35 +848,55 @@ def correlate(image, kernel, boundary_behavior):
     separate structure to represent the output.
 
     kernel is represented as a 2D list, e.g. [[0, 0, 0], [0, 0, 0], [0, 0, 0]]
-    where each nested list is a row.
+    where each nested list is a row.  Kernels may be rectangular, and of odd
+    or even size; the kernel entry at (len(row)//2, len(kernel)//2) is the one
+    over the output pixel.
     """
+    if backend is not None:
+        return backend.correlate(image, kernel, boundary_behavior)
 
     if boundary_behavior not in ("zero", "extend", "wrap"):
         return None
+    if any(len(kern_row) != len(kernel[0]) for kern_row in kernel):
+        raise ValueError('Kernel rows must all have the same length')
+
+    # rank-1 kernels (e.g. Sobel) can be applied as two cheap 1D passes, when
+    # that adds up exactly the same sums
+    factors = exact_separable_factors(kernel, integer_magnitude(image['pixels']))
+    if factors is not None:
+        return correlate_separable(image, *factors, boundary_behavior)
 
     img_width = image['width']
     img_height = image['height']
 
-    kernel_size = len(kernel) # kernel is square so true for height and width
-    k_range = int(kernel_size / 2) # distance from center of kernel to edge
+    kernel_height = len(kernel)
+    kernel_width = len(kernel[0])
+    # distance from the center of the kernel to its top and left edges
+    y_range = kernel_height // 2
+    x_range = kernel_width // 2
+
+    # pad the image once, so that the pixels around pixel (x,y), from the top
+    # left corner (x-x_range, y-y_range) to the bottom right corner
+    # (x+kernel_width-x_range-1, y+kernel_height-y_range-1), are found at
+    # padded[y+kern_y][x+kern_x] without any bounds checks
+    padded = pad_image(image, y_range, kernel_height - y_range - 1,
+                       x_range, kernel_width - x_range - 1, boundary_behavior)
 
     new_img = []
 
     for y in range(img_height):
-        for x in range(img_width):
-            pixel_sum = 0
-
-            # gets values of pixels around pixel (x,y) moving from
-            # the top left corner (x-k_range, y-k_range) ->
-            # bottom right corner (x+kernel_size-k_range) == (x+k_range)
-
-            for kern_y in range(kernel_size):
-                for kern_x in range(kernel_size):
-                    pix = get_pixel_new(image, x+kern_x-k_range,
-                        y+kern_y-k_range, boundary_behavior)
-                    scale_factor = kernel[kern_y][kern_x]
-                    pixel_sum += pix*scale_factor
-            new_img.append(pixel_sum)
+        # accumulates one whole row of output at a time, adding the kernel
+        # taps in the same order for every pixel
+        row_sum = [0]*img_width
+        for kern_y in range(kernel_height):
+            padded_row = padded[y+kern_y]
+            for kern_x in range(kernel_width):
+                scale_factor = kernel[kern_y][kern_x]
+                if scale_factor == 0:
+                    continue
+                row_sum = [total + pix*scale_factor for total, pix in
+                           zip(row_sum, padded_row[kern_x:kern_x+img_width])]
+        new_img.extend(row_sum)
 
     return pixel_list_to_img(image, new_img)
     # return {'height': img_height, 'width': img_width, 'pixels': new_img}
@@ -213,6 +914,8 @@ def round_and_clip_image(image):
     255 in the output; and any locations with values lower than 0 in the input
     should have value 0 in the output.
     """
+    if backend is not None:
+        return backend.round_and_clip_image(image)
 
     rounded = []
     for pixel in image['pixels']:
@@ -225,6 +928,137 @@ def round_and_clip_image(image):
     return pixel_list_to_img(image, rounded)
     # return {'height': image['height'], 'width': image['width'], 'pixels': rounded}
 
+# FIXED-POINT CORRELATION
+
+# largest common denominator used for the weights of an integer kernel
+MAX_KERNEL_DENOMINATOR = 2**20
+
+def rational_weight(weight, max_denominator=MAX_KERNEL_DENOMINATOR):
+    """
+    Finds a fraction that a kernel weight represents, such as 1/9 for the
+    float 0.1111111111111111.
+
+    Returns:
+      A tuple (numerator, denominator) of integers such that
+      numerator/denominator == weight, found from the continued fraction of
+      the weight, or None if there is none with a denominator of at most
+      max_denominator
+    """
+    if isinstance(weight, int):
+        return weight, 1
+    if not isinstance(weight, float) or not math.isfinite(weight):
+        return None
+    num, den = weight.as_integer_ratio()
+    prev_num, frac_num, prev_den, frac_den = 0, 1, 1, 0
+    while den:
+        term, remainder = divmod(num, den)
+        prev_num, frac_num = frac_num, term*frac_num + prev_num
+        prev_den, frac_den = frac_den, term*frac_den + prev_den
+        if frac_den > max_denominator:
+            return None
+        if frac_num / frac_den == weight:
+            return frac_num, frac_den
+        num, den = den, remainder
+    return None
+
+def integer_kernel(kernel):
+    """
+    Scales a kernel of integer or rational weights (see rational_weight) by a
+    common denominator.
+
+    Returns:
+      A tuple (scaled_kernel, denominator), where scaled_kernel holds
+      integers equal to denominator times each weight, or None if some weight
+      is not such a fraction or the common denominator would be too large
+    """
+    fractions = []
+    denominator = 1
+    for kern_row in kernel:
+        row = []
+        for weight in kern_row:
+            fraction = rational_weight(weight)
+            if fraction is None:
+                return None
+            denominator = math.lcm(denominator, fraction[1])
+            if denominator > MAX_KERNEL_DENOMINATOR:
+                return None
+            row.append(fraction)
+        fractions.append(row)
+    scaled_kernel = [[num * (denominator // den) for num, den in row]
+                     for row in fractions]
+    return scaled_kernel, denominator
+
+def correlate_pixels(image, kernel, positions, boundary_behavior):
+    """
+    Computes the pixels at the given (x, y) positions of
+    correlate(image, kernel, boundary_behavior) on their own, adding up the
+    same float terms in the same row-major order as correlate (whose
+    separable path only differs where the sums are exact).  Returns a list
+    of values, one per position.
+    """
+    values = []
+    for x, y in positions:
+        total = 0
+        for kern_y, kern_row in enumerate(kernel):
+            for kern_x, scale_factor in enumerate(kern_row):
+                if scale_factor != 0:
+                    pix = get_pixel_new(image, x+kern_x-len(kern_row)//2,
+                                        y+kern_y-len(kernel)//2,
+                                        boundary_behavior)
+                    total = total + pix*scale_factor
+        values.append(total)
+    return values
+
+def correlate_and_round(image, kernel, boundary_behavior):
+    """
+    Computes round_and_clip_image(correlate(image, kernel, boundary_behavior))
+    with integer arithmetic where possible.
+
+    For an image of integer pixels and a kernel of integer or rational
+    weights, the kernel is scaled by a common denominator D, the image is
+    correlated with the integer kernel (so that every sum is an exact
+    integer S), and each output is rounded once, as S/D.
+
+    The float correlation differs from S/D by far less than the distance from
+    S/D to the nearest rounding boundary, except when S/D is exactly halfway
+    between two integers; those ties round according to the float summation
+    order, so they are recomputed with correlate_pixels.  The results are
+    therefore bit-identical to the float computation.
+    """
+    if boundary_behavior not in ("zero", "extend", "wrap"):
+        return None
+
+    pixels = image['pixels']
+    scaled = integer_kernel(kernel)
+    if scaled is None or not pixels or not (
+            pixel_bytes(pixels) is not None
+            or all(isinstance(pix, int) for pix in pixels)):
+        return round_and_clip_image(correlate(image, kernel, boundary_behavior))
+    scaled_kernel, denominator = scaled
+
+    # bound on the error of the float correlation, which must stay below the
+    # 1/(2*D) that separates S/D from a rounding boundary
+    taps = sum(len(kern_row) for kern_row in kernel)
+    total_weight = sum(abs(weight) for kern_row in kernel for weight in kern_row)
+    largest = max(max(pixels), -min(pixels))
+    if (taps + 4) * largest * total_weight * 2**-52 >= 1 / (2*denominator):
+        return round_and_clip_image(correlate(image, kernel, boundary_behavior))
+
+    width = image['width']
+    sums = correlate(image, scaled_kernel, boundary_behavior)['pixels']
+    # round(S/D), correct wherever S/D is not a tie
+    rounded = [(2*total + denominator) // (2*denominator) for total in sums]
+    if denominator % 2 == 0:
+        half = denominator // 2
+        ties = [i for i, total in enumerate(sums) if total % denominator == half]
+        tie_values = correlate_pixels(image, kernel,
+                                      [(i % width, i // width) for i in ties],
+                                      boundary_behavior)
+        for i, value in zip(ties, tie_values):
+            rounded[i] = round(value)
+    return pixel_list_to_img(image, [0 if value < 0 else 255 if value > 255 else value
+                                     for value in rounded])
+
 # FILTERS
 
 def create_blur_kernel(n):
@@ -242,6 +1076,78 @@ def create_blur_kernel(n):
         kernel.append(row)
     return kernel
 
+# Gaussian kernels extend GAUSSIAN_TRUNCATE standard deviations either side
+GAUSSIAN_TRUNCATE = 4.0
+# from this standard deviation on, Gaussian blurs are approximated with
+# GAUSSIAN_BOX_PASSES running-sum box blurs
+GAUSSIAN_BOX_SIGMA = 3.0
+GAUSSIAN_BOX_PASSES = 3
+
+def gaussian_kernel(sigma):
+    """
+    Creates a 1D Gaussian kernel with standard deviation sigma, truncated at
+    GAUSSIAN_TRUNCATE standard deviations and normalized to sum to 1.  The
+    2D Gaussian is the outer product of this kernel with itself.
+    """
+    radius = int(GAUSSIAN_TRUNCATE*sigma + 0.5)
+    if radius == 0:
+        return [1]
+    weights = [math.exp(-x*x / (2*sigma*sigma)) for x in range(-radius, radius+1)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+def gaussian_box_sizes(sigma):
+    """
+    Returns the (odd) sizes of GAUSSIAN_BOX_PASSES box blurs which, applied
+    in turn, approximate a Gaussian blur with standard deviation sigma: the
+    sizes are as equal as possible, and the variances ((n*n - 1)/12) of the
+    boxes add up as closely as possible to sigma**2.
+    """
+    passes = GAUSSIAN_BOX_PASSES
+    ideal = math.sqrt(12*sigma*sigma / passes + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    # how many of the passes use the smaller size
+    smaller = round((12*sigma*sigma - passes*lower*lower - 4*passes*lower - 3*passes)
+                    / (-4*lower - 4))
+    smaller = min(passes, max(0, smaller))
+    return [lower]*smaller + [lower + 2]*(passes - smaller)
+
+def gaussian_reach(sigma):
+    """
+    Returns how many pixels on each side of a pixel gaussian_blurred reads
+    """
+    if sigma >= GAUSSIAN_BOX_SIGMA:
+        return sum(n // 2 for n in gaussian_box_sizes(sigma))
+    return len(gaussian_kernel(sigma)) // 2
+
+def gaussian_blurred(image, sigma):
+    """
+    Return a new image representing the result of applying a Gaussian blur
+    with standard deviation sigma to the given input image, using 'extend'
+    boundary behavior.
+
+    The kernel is separable, so it is applied as two 1D correlations (a
+    1-row kernel, then a 1-column kernel).  For sigma of at least
+    GAUSSIAN_BOX_SIGMA, the blur is instead approximated by repeated box
+    blurs computed with running sums (see gaussian_box_sizes), so the cost
+    per pixel stays the same however large sigma is.
+    """
+    if sigma < 0:
+        raise ValueError('The standard deviation must not be negative')
+    if sigma >= GAUSSIAN_BOX_SIGMA:
+        sizes = gaussian_box_sizes(sigma)
+        divisor = math.prod(sizes)**2
+        values = [total / divisor for row in repeated_box_sums(image, sizes)
+                  for total in row]
+        return round_and_clip_image(pixel_list_to_img(image, values))
+
+    weights = gaussian_kernel(sigma)
+    horizontal = correlate(image, [weights], 'extend')
+    return round_and_clip_image(
+        correlate(horizontal, [[weight] for weight in weights], 'extend'))
+
 def blurred(image, n):
     """
     Return a new image representing the result of applying a box blur (with
@@ -252,6 +1158,12 @@ def blurred(image, n):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
     """
+    # integer images use running sums, so the cost does not grow with n
+    # (a backend instead does the whole correlation at once)
+    values = box_blur_values(image, n) if backend is None else None
+    if values is not None:
+        return round_and_clip_image(pixel_list_to_img(image, values))
+
     # first, create a representation for the appropriate n-by-n kernel (you may
     # wish to define another helper function for this)
     kernel = create_blur_kernel(n)
@@ -277,6 +1189,11 @@ def sharpened(image, n):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
     """
+    # integer images are sharpened in a single pass over running box sums
+    values = unsharp_values(image, n) if backend is None else None
+    if values is not None:
+        return pixel_list_to_img(image, values)
+
     blur_kernel = create_blur_kernel(n)
     blurred = correlate(image, blur_kernel, 'extend')
 
@@ -301,6 +1218,17 @@ def edges(image):
     This process should not mutate the input image; rather, it should create a
     separate structure to represent the output.
     """
+    if backend is not None:
+        return backend.edges(image)
+
+    pixels = image['pixels']
+    if pixel_bytes(pixels) is not None or all(isinstance(pix, int) for pix in pixels):
+        # integer images: both gradients and the magnitude in a single pass
+        Oxy = [] if isinstance(pixels, list) else bytearray()
+        for row in sobel_magnitude_rows(image):
+            Oxy.extend(row)
+        return {'height': image['height'], 'width': image['width'], 'pixels': Oxy}
+
     Kx = [[-1, 0, 1],
           [-2, 0, 2],
           [-1, 0, 1]]
@@ -321,6 +1249,7 @@ def edges(image):
     rounded = round_and_clip_image(Oxy_img)
 
     return rounded
+edges.spec = ('edges',)
 
 
 # COLOR FILTERS
@@ -334,6 +1263,16 @@ def split_to_grayscale(image):
     Returns:
       3 grayscale images, each representing a color layer
     """
+    if backend is not None:
+        return backend.split_to_grayscale(image)
+
+    if isinstance(image['pixels'], ColorPixels):
+        # every third byte of the interleaved buffer is one layer
+        data = image['pixels'].data
+        return pixel_list_to_img(image, data[0::3]), \
+            pixel_list_to_img(image, data[1::3]), \
+            pixel_list_to_img(image, data[2::3])
+
     red_layer = []
     green_layer = []
     blue_layer = []
@@ -350,7 +1289,16 @@ def merge_to_color(red_layer, green_layer, blue_layer):
     """
     Merges 3 grayscale images into one RGB image
     """
-    combined = zip(red_layer['pixels'], green_layer['pixels'], blue_layer['pixels'])
+    if backend is not None:
+        return backend.merge_to_color(red_layer, green_layer, blue_layer)
+
+    layers = (red_layer['pixels'], green_layer['pixels'], blue_layer['pixels'])
+    if all(isinstance(layer, bytearray) for layer in layers):
+        data = bytearray(3*len(layers[0]))
+        data[0::3], data[1::3], data[2::3] = layers
+        return pixel_list_to_img(red_layer, ColorPixels(data))
+
+    combined = zip(*layers)
     return pixel_list_to_img(red_layer, list(combined))
 
 def color_filter_from_greyscale_filter(filt):
@@ -365,6 +1313,10 @@ def color_filter_from_greyscale_filter(filt):
         g_processed = filt(green)
         b_processed = filt(blue)
         return merge_to_color(r_processed, g_processed, b_processed)
+    # lets filter_cascade run this filter on already-split color layers
+    color_filt.layer_filters = (filt, filt, filt)
+    if hasattr(filt, 'spec'):
+        color_filt.spec = ('color', filt.spec)
     return color_filt
 
 
@@ -375,6 +1327,7 @@ def make_blur_filter(n):
     """
     def blur(image):
         return blurred(image, n)
+    blur.spec = ('blur', n)
     return blur
 
 
@@ -385,64 +1338,727 @@ def make_sharpen_filter(n):
     """
     def sharp(image):
         return sharpened(image, n)
+    sharp.spec = ('sharpen', n)
     return sharp
 
+def make_gaussian_filter(sigma):
+    """
+    Given a standard deviation sigma, returns a function that takes a
+    grayscale image as input and produces the image with a Gaussian blur (see
+    gaussian_blurred).
+    """
+    def gaussian(image):
+        return gaussian_blurred(image, sigma)
+    gaussian.spec = ('gaussian', sigma)
+    return gaussian
+
 def color_scale_filter(r=1, g=1, b=1):
     """
     Given three color values, returns a function that takes an RGB image
     as input and returns an RGB image with its layers scaled by the parameters
     """
+    def make_layer_scale(n):
+        lut = clipped_scale_lut(n)
+        def scale_layer(layer):
+            result = apply_lut(layer, lut)
+            if result is None:
+                result = round_and_clip_image(scaled(layer, n))
+            return result
+        return scale_layer
+
+    scale_red = make_layer_scale(r)
+    scale_green = make_layer_scale(g)
+    scale_blue = make_layer_scale(b)
+
     def scale(image):
         assert type(image['pixels'][0]) == tuple
         red, green, blue = split_to_grayscale(image)
 
-        scaled_red = round_and_clip_image(scaled(red, r))
-        scaled_green = round_and_clip_image(scaled(green, g))
-        scaled_blue = round_and_clip_image(scaled(blue, b))
+        scaled_red = scale_red(red)
+        scaled_green = scale_green(green)
+        scaled_blue = scale_blue(blue)
 
         return merge_to_color(scaled_red, scaled_green, scaled_blue)
+    scale.layer_filters = (scale_red, scale_green, scale_blue)
+    scale.spec = ('color_scale', r, g, b)
     return scale
 
 
-def filter_cascade(filters):
+def make_correlate_filter(kernel):
+    """
+    Given a kernel, returns a function that takes a grayscale image as input
+    and produces the image correlated with that kernel (using 'extend'
+    behavior), rounded and clipped.
+    """
+    def correlate_filt(image):
+        return correlate_and_round(image, kernel, 'extend')
+    correlate_filt.spec = ('kernel', tuple(tuple(row) for row in kernel))
+    return correlate_filt
+
+
+def filter_from_spec(spec):
+    """
+    Builds a filter from its description (the `spec` attribute of the filters
+    made in this file), e.g. ('blur', 5) or ('color', ('edges',))
+    """
+    kind = spec[0]
+    if kind == 'invert':
+        return inverted
+    elif kind == 'edges':
+        return edges
+    elif kind == 'blur':
+        return make_blur_filter(spec[1])
+    elif kind == 'sharpen':
+        return make_sharpen_filter(spec[1])
+    elif kind == 'gaussian':
+        return make_gaussian_filter(spec[1])
+    elif kind == 'kernel':
+        return make_correlate_filter([list(row) for row in spec[1]])
+    elif kind == 'color':
+        return color_filter_from_greyscale_filter(filter_from_spec(spec[1]))
+    elif kind == 'color_scale':
+        return color_scale_filter(*spec[1:])
+    raise ValueError('Unknown filter: %r' % (spec,))
+
+
+# FILTER CASCADE OPTIMIZATION
+
+def point_luts(spec):
+    """
+    Given a filter description, returns a tuple of 256-byte lookup tables
+    (one for a grayscale filter, one per color layer for a color filter)
+    giving the filter's output for each possible input value, or None if the
+    filter is not a point operation.
+
+    The tables describe the filter on images whose pixels are integers in the
+    range [0, 255], which is what every filter in this file outputs.
+    """
+    kind = spec[0]
+    if kind == 'invert':
+        return (INVERTED_LUT,)
+    elif kind in ('blur', 'sharpen') and spec[1] == 1:
+        # a 1x1 box leaves valid pixels unchanged
+        return (bytes(range(256)),)
+    elif kind == 'gaussian' and gaussian_reach(spec[1]) == 0:
+        return (bytes(range(256)),)
+    elif kind == 'color':
+        luts = point_luts(spec[1])
+        return None if luts is None else luts*3
+    elif kind == 'color_scale':
+        return tuple(clipped_scale_lut(n) for n in spec[1:])
+    return None
+
+
+def filter_reach(spec):
+    """
+    Given a filter description, returns a tuple (above, below) of how many
+    rows above and below each output row the filter reads, or None if that
+    is not known for this kind of filter.
+    """
+    kind = spec[0]
+    if kind in ('invert', 'color_scale'):
+        return (0, 0)
+    elif kind == 'edges':
+        return (1, 1)
+    elif kind == 'gaussian':
+        return (gaussian_reach(spec[1]),)*2
+    elif kind in ('blur', 'sharpen'):
+        size = spec[1]
+    elif kind == 'kernel':
+        size = len(spec[1])
+    elif kind == 'color':
+        return filter_reach(spec[1])
+    else:
+        return None
+    return (size // 2, size - size // 2 - 1)
+
+
+def make_lut_filter(luts, filters):
+    """
+    Combines a run of point-operation filters into a single filter that maps
+    each pixel through composed lookup tables in one pass.
+
+    Parameters:
+      * luts (tuple) : the composed lookup tables (one for grayscale, three
+            for color; see point_luts)
+      * filters (list) : the original filters, which are applied in turn
+            instead if the input has pixels the tables do not cover
+    """
+    def make_layer_filter(lut, layer_filters):
+        def lut_layer(image):
+            result = apply_lut(image, lut)
+            if result is not None:
+                return result
+            for filt in layer_filters:
+                image = filt(image)
+            return image
+        return lut_layer
+
+    if len(luts) == 1:
+        return make_layer_filter(luts[0], filters)
+
+    if all(hasattr(filt, 'layer_filters') for filt in filters):
+        layer_filters = tuple(
+            make_layer_filter(lut, [filt.layer_filters[layer] for filt in filters])
+            for layer, lut in enumerate(luts))
+    else:
+        # filters that cannot be split into layers (e.g. wrapped by
+        # cache.FilterCache.cached) are applied whole to inputs the tables
+        # do not cover
+        layer_filters = None
+    def lut_filter(image):
+        if isinstance(image['pixels'], ColorPixels) and luts[0] == luts[1] == luts[2]:
+            # the same table for every layer maps the interleaved bytes directly
+            data = image['pixels'].data.translate(luts[0])
+            return pixel_list_to_img(image, ColorPixels(data))
+        layers = split_to_grayscale(image)
+        if layer_filters is not None:
+            return merge_to_color(*(filt(layer) for filt, layer in
+                                    zip(layer_filters, layers)))
+        results = [apply_lut(layer, lut) for layer, lut in zip(layers, luts)]
+        if None not in results:
+            return merge_to_color(*results)
+        for filt in filters:
+            image = filt(image)
+        return image
+    if layer_filters is not None:
+        lut_filter.layer_filters = layer_filters
+    return lut_filter
+
+
+def convolve_kernels(first, second):
+    """
+    Returns a kernel such that correlating an image with it is the same as
+    correlating with `first` and then with `second` (ignoring rounding and
+    boundary effects).
+    """
+    def combined_size(first_size, second_size):
+        size = first_size + second_size - 1
+        if first_size % 2 == 0 and second_size % 2 == 0:
+            # keeps the center offset equal to the sum of both kernels' offsets
+            size += 1
+        return size
+    height = combined_size(len(first), len(second))
+    width = combined_size(len(first[0]), len(second[0]))
+    kernel = [[0]*width for _ in range(height)]
+    for y1, row1 in enumerate(first):
+        for x1, value1 in enumerate(row1):
+            for y2, row2 in enumerate(second):
+                for x2, value2 in enumerate(row2):
+                    kernel[y1+y2][x1+x2] += value1*value2
+    return kernel
+
+
+def blur_kernel_spec(spec):
+    """
+    Returns the kernel applied by a blur filter description (a grayscale
+    box blur or merged kernel, possibly wrapped in a color filter), along
+    with whether it is a color filter, or None for any other filter
+    """
+    is_color = spec[0] == 'color'
+    if is_color:
+        spec = spec[1]
+    if spec[0] == 'blur':
+        return create_blur_kernel(spec[1]), is_color
+    elif spec[0] == 'kernel':
+        return [list(row) for row in spec[1]], is_color
+    return None
+
+
+def optimize_filters(filters, exact=True):
+    """
+    Given a list of filters, returns a list of filters that produces the same
+    output when applied in turn, but does less work.
+
+    Consecutive point operations (invert, color scaling, and 1x1 blurs and
+    sharpens, alone or as color filters) are folded into a single lookup-table
+    pass, which also removes their intermediate rounding and clipping.
+
+    If exact is False, consecutive box blurs are also merged into a single
+    correlation with a combined kernel and rounded only once.  This is faster
+    for long chains but can differ slightly from applying the blurs in turn
+    (intermediate rounding and 'extend' edges are not reproduced).
+
+    Filters without a `spec` attribute are kept as they are.
+    """
+    optimized = []
+    run = []
+    run_luts = None
+
+    def end_run():
+        if len(run) == 1:
+            optimized.append(run[0])
+        elif run:
+            optimized.append(make_lut_filter(run_luts, run))
+        run.clear()
+
+    for filt in filters:
+        spec = getattr(filt, 'spec', None)
+        luts = point_luts(spec) if spec is not None else None
+        if luts is not None:
+            if run and len(luts) != len(run_luts):
+                end_run()
+            if run:
+                # composing two tables is mapping one through the other
+                run_luts = tuple(previous.translate(lut)
+                                 for previous, lut in zip(run_luts, luts))
+            else:
+                run_luts = luts
+            run.append(filt)
+            continue
+        end_run()
+
+        if not exact and spec is not None and optimized:
+            current = blur_kernel_spec(spec)
+            previous = getattr(optimized[-1], 'spec', None)
+            previous = blur_kernel_spec(previous) if previous else None
+            if current and previous and current[1] == previous[1]:
+                merged = make_correlate_filter(
+                    convolve_kernels(previous[0], current[0]))
+                if current[1]:
+                    merged = color_filter_from_greyscale_filter(merged)
+                optimized[-1] = merged
+                continue
+        optimized.append(filt)
+    end_run()
+    return optimized
+
+
+def filter_cascade(filters, exact=True):
     """
     Given a list of filters (implemented as functions on images), returns a new
     single filter such that applying that filter to an image produces the same
     output as applying each of the individual ones in turn.
+
+    The list is first simplified with optimize_filters (see there for the
+    meaning of exact).  Consecutive color filters that work on each color
+    layer separately (those with a `layer_filters` attribute, from
+    color_filter_from_greyscale_filter and color_scale_filter) are then run on
+    planar layers: the image is split into layers once before such a run and
+    merged once after it, instead of once per filter.
     """
+    filters = optimize_filters(filters, exact)
+
     def all_filter(image):
         nested_filters = image
-        for filt in filters:
-            nested_filters = filt(nested_filters)
+        i = 0
+        while i < len(filters):
+            if not hasattr(filters[i], 'layer_filters'):
+                nested_filters = filters[i](nested_filters)
+                i += 1
+                continue
+
+            layers = split_to_grayscale(nested_filters)
+            while i < len(filters) and hasattr(filters[i], 'layer_filters'):
+                layers = [layer_filt(layer) for layer_filt, layer in
+                          zip(filters[i].layer_filters, layers)]
+                i += 1
+            nested_filters = merge_to_color(*layers)
         return nested_filters
     return all_filter
 
 
+# IMAGE PYRAMIDS
+
+def downsampled(image):
+    """
+    Returns a half-size version of the given (grayscale or color) image, in
+    which each pixel is the average of a 2x2 block of pixels.  Images with an
+    odd width or height are extended by repeating their last column or row.
+    Integer averages are rounded (halves upward).
+    """
+    width = image['width']
+    height = image['height']
+    pixels = image['pixels']
+    if isinstance(pixels, ColorPixels) or (pixels and isinstance(pixels[0], tuple)):
+        return merge_to_color(*(downsampled(layer)
+                                for layer in split_to_grayscale(image)))
+
+    rows = [pixels[y*width:(y+1)*width] for y in range(height)]
+    if height % 2:
+        rows.append(rows[-1])
+    integers = pixel_bytes(pixels) is not None or all(
+        isinstance(pix, int) for pix in pixels)
+    new_pixels = []
+    for top, bottom in zip(rows[0::2], rows[1::2]):
+        sums = [a + b for a, b in zip(top, bottom)]
+        if width % 2:
+            sums.append(sums[-1])
+        sums = [a + b for a, b in zip(sums[0::2], sums[1::2])]
+        new_pixels.extend([(s + 2) // 4 for s in sums] if integers else
+                          [s / 4 for s in sums])
+    if not isinstance(pixels, list):
+        new_pixels = compact_pixels(new_pixels)
+    return {'height': (height + 1) // 2, 'width': (width + 1) // 2,
+            'pixels': new_pixels}
+
+
+def preview_spec(spec, level):
+    """
+    Given a filter description, returns the description of the filter that
+    has the same effect on an image downsampled `level` times (see
+    downsampled): box kernel sizes and Gaussian standard deviations are
+    divided by 2**level, keeping box sizes odd if they were.  Point
+    operations and edges are unchanged, as are arbitrary kernels (which
+    cannot be rescaled).
+    """
+    factor = 2**level
+    kind = spec[0]
+    if kind in ('blur', 'sharpen'):
+        n = spec[1]
+        if n % 2:
+            # the nearest odd size, so the box stays centered on the pixel
+            return (kind, max(1, 2*round((n/factor - 1) / 2) + 1))
+        return (kind, max(1, round(n / factor)))
+    elif kind == 'gaussian':
+        return (kind, spec[1] / factor)
+    elif kind == 'color':
+        return (kind, preview_spec(spec[1], level))
+    return spec
+
+
+def preview_filter(filt, level):
+    """
+    Returns a version of the given filter to run on an image downsampled
+    `level` times (see preview_spec).  Filters without a `spec` are returned
+    as they are.
+    """
+    spec = getattr(filt, 'spec', None)
+    if spec is None or level == 0:
+        return filt
+    return filter_from_spec(preview_spec(spec, level))
+
+
+class ImagePyramid:
+    """
+    An image together with half-size versions of it (levels 1, 2, ...,
+    computed only when first needed) and a list of filters to apply to it.
+
+    preview(level) applies the filters, scaled to match (see preview_filter),
+    to the image at that level; full() (or save) applies them at full
+    resolution, which is only computed when it is asked for.  Results are
+    kept, so each level is filtered at most once.
+
+    Invoked as, for example:
+       pyramid = ImagePyramid(load_color_image('test_images/frog.png'))
+       blurred = pyramid.filtered(color_filter_from_greyscale_filter(make_blur_filter(9)))
+       thumbnail = blurred.preview_for_size(64, 64)
+       blurred.save('frog_blurred.png')
+    """
+    def __init__(self, image, filters=(), levels=None):
+        self.width = image['width']
+        self.height = image['height']
+        self.filters = list(filters)
+        # the unfiltered image at each level computed so far, shared by all
+        # of the pyramids made from this one by filtered()
+        self.levels = levels if levels is not None else [image]
+        self.previews = {}
+
+    def level(self, n):
+        """
+        Returns the unfiltered image downsampled n times
+        """
+        while len(self.levels) <= n:
+            self.levels.append(downsampled(self.levels[-1]))
+        return self.levels[n]
+
+    def level_size(self, n):
+        """
+        Returns the (width, height) of the image at level n
+        """
+        return -(-self.width // 2**n), -(-self.height // 2**n)
+
+    def filtered(self, filt):
+        """
+        Returns a new pyramid for this image with one more filter applied
+        """
+        return ImagePyramid(self.levels[0], self.filters + [filt], self.levels)
+
+    def preview(self, level=1):
+        """
+        Returns the filtered image at the given level
+        """
+        if level not in self.previews:
+            filters = [preview_filter(filt, level) for filt in self.filters]
+            self.previews[level] = filter_cascade(filters)(self.level(level))
+        return self.previews[level]
+
+    def preview_for_size(self, max_width, max_height):
+        """
+        Returns the filtered image at the most detailed level that fits in
+        max_width by max_height (or the smallest level, 1 pixel across)
+        """
+        level = 0
+        while (self.level_size(level) != (1, 1) and
+               (self.level_size(level)[0] > max_width or
+                self.level_size(level)[1] > max_height)):
+            level += 1
+        return self.preview(level)
+
+    def full(self):
+        """
+        Returns the filtered image at full resolution
+        """
+        return self.preview(0)
+
+    def save(self, filename, mode='PNG'):
+        """
+        Saves the filtered image at full resolution (see save_color_image and
+        save_greyscale_image)
+        """
+        image = self.full()
+        pixels = image['pixels']
+        if isinstance(pixels, ColorPixels) or (pixels and isinstance(pixels[0], tuple)):
+            save_color_image(image, filename, mode)
+        else:
+            save_greyscale_image(image, filename, mode)
+
+
+# SEAM CARVING
+
+def image_rows(image):
+    """
+    Returns the pixels of the given image as a list of rows, each a new list
+    """
+    pixels = list(image['pixels'])
+    width = image['width']
+    return [pixels[y*width:(y+1)*width] for y in range(image['height'])]
+
+
+def image_from_rows(rows, like):
+    """
+    Builds an image from a list of rows of pixels, with the same kind of
+    pixel container as the image `like`
+    """
+    pixels = [pix for row in rows for pix in row]
+    if not isinstance(like['pixels'], list):
+        pixels = compact_pixels(pixels)
+    return {'height': len(rows), 'width': len(rows[0]) if rows else 0,
+            'pixels': pixels}
+
+
+def greyscale_image_from_color_image(image):
+    """
+    Given a color image, computes and returns a corresponding greyscale image.
+
+    Returns a greyscale image (represented as a dictionary).
+    """
+    return pixel_list_to_img(image, [round(.299 * r + .587 * g + .114 * b)
+                                     for r, g, b in image['pixels']])
+
+
+def compute_energy(grey):
+    """
+    Given a greyscale image, computes a measure of "energy", in our case using
+    the edges function from last week.
+
+    Returns a greyscale image (represented as a dictionary).
+    """
+    return edges(grey)
+
+
+def cumulative_row(above, energy_row, x):
+    """
+    Returns the cumulative energy at column x of a row, given the cumulative
+    energies of the row above it and the energies of the row itself
+    """
+    return energy_row[x] + min(above[max(0, x-1):x+2])
+
+
+def cumulative_energy_map(energy):
+    """
+    Given a measure of energy (e.g., the output of the compute_energy
+    function), computes a "cumulative energy map" as described in the lab 2
+    writeup.
+
+    Returns a dictionary with 'height', 'width', and 'pixels' keys (but where
+    the values in the 'pixels' array may not necessarily be in the range [0,
+    255].
+    """
+    rows = image_rows(energy)
+    for y in range(1, len(rows)):
+        above, row = rows[y-1], rows[y]
+        rows[y] = [cumulative_row(above, row, x) for x in range(len(row))]
+    return image_from_rows(rows, energy)
+
+
+def seam_columns(cumulative_rows):
+    """
+    Given the rows of a cumulative energy map, returns the column of the
+    minimum-energy seam in each row, top to bottom.  Ties are broken towards
+    the left.
+    """
+    bottom = cumulative_rows[-1]
+    x = bottom.index(min(bottom))
+    columns = [x]
+    for row in reversed(cumulative_rows[:-1]):
+        start = max(0, x-1)
+        window = row[start:x+2]
+        x = start + window.index(min(window))
+        columns.append(x)
+    columns.reverse()
+    return columns
+
+
+def minimum_energy_seam(cem):
+    """
+    Given a cumulative energy map, returns a list of the indices into the
+    'pixels' list that correspond to pixels contained in the minimum-energy
+    seam (computed as described in the lab 2 writeup).
+    """
+    width = cem['width']
+    columns = seam_columns(image_rows(cem))
+    return [y*width + x for y, x in reversed(list(enumerate(columns)))]
+
+
+def image_without_seam(image, seam):
+    """
+    Given a (color) image and a list of indices to be removed from the image,
+    return a new image (without modifying the original) that contains all the
+    pixels from the original image except those corresponding to the locations
+    in the given list.
+    """
+    rows = image_rows(image)
+    width = image['width']
+    for index in sorted(seam, reverse=True):
+        del rows[index // width][index % width]
+    return image_from_rows(rows, image)
+
+
+def sobel_magnitude(rows, x, y):
+    """
+    Returns the value that edges gives for pixel (x, y) of the image with the
+    given rows
+    """
+    above = rows[max(0, y-1)]
+    row = rows[y]
+    below = rows[min(len(rows)-1, y+1)]
+    left = max(0, x-1)
+    right = min(len(row)-1, x+1)
+    gx = (above[right] + 2*row[right] + below[right]) - \
+         (above[left] + 2*row[left] + below[left])
+    gy = (below[left] + 2*below[x] + below[right]) - \
+         (above[left] + 2*above[x] + above[right])
+    return min(255, round(math.sqrt(gx**2 + gy**2)))
+
+
+def remove_seam_from_maps(columns, grey_rows, energy_rows, cumulative_rows):
+    """
+    Removes the seam with the given columns (one per row) from the rows of a
+    greyscale image and of its energy and cumulative energy maps, updating
+    the maps in place.
+
+    Only the energies next to the seam can change, so only those are
+    recomputed.  Cumulative energies are recomputed where the energy or the
+    neighbors above changed, and the changed region is narrowed again to the
+    values that actually differ from before, so that it does not widen all
+    the way down the image.
+    """
+    for rows in (grey_rows, energy_rows, cumulative_rows):
+        for row, x in zip(rows, columns):
+            del row[x]
+    height = len(grey_rows)
+    width = len(grey_rows[0])
+
+    changed = None
+    for y in range(height):
+        # pixels whose 3x3 neighborhood now holds different pixels
+        near = columns[max(0, y-1):y+2]
+        energy_row = energy_rows[y]
+        for x in range(max(0, min(near)-1), min(width-1, max(near)) + 1):
+            energy_row[x] = sobel_magnitude(grey_rows, x, y)
+
+        low, high = min(near)-1, max(near)
+        if changed is not None:
+            low = min(low, changed[0]-1)
+            high = max(high, changed[1]+1)
+        row = cumulative_rows[y]
+        above = cumulative_rows[y-1] if y > 0 else None
+        changed = None
+        for x in range(max(0, low), min(width-1, high) + 1):
+            value = energy_row[x] if above is None else cumulative_row(above, energy_row, x)
+            if value != row[x]:
+                row[x] = value
+                changed = (x if changed is None else changed[0], x)
+
+
+def seam_carving(image, ncols):
+    """
+    Starting from the given image, use the seam carving technique to remove
+    ncols (an integer) columns from the image.
+
+    The energy and cumulative energy maps are computed once, then updated
+    around each removed seam rather than recomputed from scratch.
+    """
+    color_rows = image_rows(image)
+    grey = greyscale_image_from_color_image(image)
+    energy = compute_energy(grey)
+    maps = (image_rows(grey), image_rows(energy),
+            image_rows(cumulative_energy_map(energy)))
+    for _ in range(ncols):
+        columns = seam_columns(maps[2])
+        for row, x in zip(color_rows, columns):
+            del row[x]
+        remove_seam_from_maps(columns, *maps)
+    return image_from_rows(color_rows, image)
+
+
 
 # HELPER FUNCTIONS FOR LOADING AND SAVING IMAGES
 
-def load_greyscale_image(filename):
+def load_greyscale_image(filename, compact=False):
     """
     Loads an image from the given file and returns an instance of this class
     representing that image.  This also performs conversion to greyscale.
 
+    If compact is True, the pixels are returned in a bytearray (see
+    compact_image) rather than a list.
+
     Invoked as, for example:
        i = load_greyscale_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
-        img_data = img.getdata()
-        if img.mode.startswith('RGB'):
-            pixels = [round(.299 * p[0] + .587 * p[1] + .114 * p[2])
-                      for p in img_data]
-        elif img.mode == 'LA':
-            pixels = [p[0] for p in img_data]
-        elif img.mode == 'L':
-            pixels = list(img_data)
-        else:
-            raise ValueError('Unsupported image mode: %r' % img.mode)
         w, h = img.size
-        return {'height': h, 'width': w, 'pixels': pixels}
+        pixels = greyscale_bytes_from_image(img)
+        return {'height': h, 'width': w,
+                'pixels': pixels if compact else list(pixels)}
+
+
+def greyscale_bytes_from_image(img):
+    """
+    Converts the pixels of an open PIL image to greyscale, in the same way as
+    load_greyscale_image, straight into a bytearray.
+
+    Color pixels are converted in bulk by PIL, which rounds slightly
+    differently from round(.299*r + .587*g + .114*b) on colors whose value
+    lies within a tiny distance of a rounding boundary.  Converting twice,
+    with the values nudged down and up by 0.001, finds exactly those pixels
+    (the two results differ by 1 there and agree everywhere else), and only
+    they are recomputed with the formula.
+    """
+    if img.mode.startswith('RGB'):
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        low = img.convert('L', matrix=(.299, .587, .114, -0.001)).tobytes()
+        high = img.convert('L', matrix=(.299, .587, .114, 0.001)).tobytes()
+        pixels = bytearray(low)
+        # every byte of high - low is 0 or 1, so one big subtraction (with no
+        # borrows) marks the pixels near a boundary with a byte 1
+        near = (int.from_bytes(high, 'little') -
+                int.from_bytes(low, 'little')).to_bytes(len(low), 'little')
+        raw = img.tobytes()
+        i = near.find(1)
+        while i != -1:
+            r, g, b = raw[3*i:3*i+3]
+            pixels[i] = round(.299 * r + .587 * g + .114 * b)
+            i = near.find(1, i + 1)
+        return pixels
+    elif img.mode == 'LA':
+        return bytearray(img.tobytes()[0::2])
+    elif img.mode == 'L':
+        return bytearray(img.tobytes())
+    raise ValueError('Unsupported image mode: %r' % img.mode)
 
 
 def save_greyscale_image(image, filename, mode='PNG'):
@@ -452,8 +2068,13 @@ def save_greyscale_image(image, filename, mode='PNG'):
     filename is given as a file-like object, the file type will be determined
     by the 'mode' parameter.
     """
-    out = Image.new(mode='L', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    size = (image['width'], image['height'])
+    data = pixel_bytes(image['pixels'])
+    if data is not None:
+        out = Image.frombytes('L', size, bytes(data))
+    else:
+        out = Image.new(mode='L', size=size)
+        out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -461,21 +2082,24 @@ def save_greyscale_image(image, filename, mode='PNG'):
     out.close()
 
 
-def load_color_image(filename):
+def load_color_image(filename, compact=False):
     """
     Loads a color image from the given file and returns a dictionary
     representing that image.
 
+    If compact is True, the pixels are returned in a ColorPixels buffer (see
+    compact_image) rather than a list of tuples.
+
     Invoked as, for example:
        i = load_color_image('test_images/cat.png')
     """
     with open(filename, 'rb') as img_handle:
         img = Image.open(img_handle)
         img = img.convert('RGB')  # in case we were given a greyscale image
-        img_data = img.getdata()
-        pixels = list(img_data)
         w, h = img.size
-        return {'height': h, 'width': w, 'pixels': pixels}
+        pixels = ColorPixels(img.tobytes())
+        return {'height': h, 'width': w,
+                'pixels': pixels if compact else list(pixels)}
 
 
 def save_color_image(image, filename, mode='PNG'):
@@ -485,8 +2109,12 @@ def save_color_image(image, filename, mode='PNG'):
     If filename is given as a file-like object, the file type will be
     determined by the 'mode' parameter.
     """
-    out = Image.new(mode='RGB', size=(image['width'], image['height']))
-    out.putdata(image['pixels'])
+    size = (image['width'], image['height'])
+    if isinstance(image['pixels'], ColorPixels):
+        out = Image.frombytes('RGB', size, bytes(image['pixels'].data))
+    else:
+        out = Image.new(mode='RGB', size=size)
+        out.putdata(image['pixels'])
     if isinstance(filename, str):
         out.save(filename)
     else:
@@ -0,0 +1,192 @@
+"""
+Whole-array NumPy versions of the lab's image operations.
+
+Calling enable() routes inverted, scaled, correlate, round_and_clip_image,
+edges, split_to_grayscale and merge_to_color in lab.py through this module.
+Each operation is performed in the same order as the pure-Python code, with
+the same IEEE double arithmetic, so the results are identical to it; only the
+per-pixel Python loops are replaced.  If NumPy is not installed, enable()
+does nothing and lab.py keeps using its pure-Python code.
+"""
+
+import sys
+
+import lab
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NUMPY_PAD_MODES = {'zero': 'constant', 'extend': 'edge', 'wrap': 'wrap'}
+
+
+def enable():
+    """
+    Makes lab.py use this module for whole-image operations.  Returns True if
+    the backend was enabled, or False if NumPy is not available.
+    """
+    if numpy is None:
+        return False
+    lab.set_backend(sys.modules[__name__])
+    return True
+
+
+def disable():
+    """
+    Makes lab.py go back to its pure-Python code
+    """
+    lab.set_backend(None)
+
+
+def to_array(pixels):
+    """
+    Converts the pixels of an image (a list, or any of the compact buffers
+    from lab.compact_pixels) to a NumPy array.  Color pixels become an array
+    with one row of 3 values per pixel.
+    """
+    if isinstance(pixels, lab.ColorPixels):
+        return numpy.frombuffer(bytes(pixels.data), dtype=numpy.uint8) \
+            .reshape(-1, 3).astype(numpy.int64)
+    if isinstance(pixels, bytearray):
+        return numpy.frombuffer(bytes(pixels), dtype=numpy.uint8) \
+            .astype(numpy.int64)
+    if isinstance(pixels, lab.NumberPixels):
+        dtype = numpy.int64 if pixels.typecode == 'q' else numpy.float64
+        return numpy.frombuffer(bytes(pixels.data), dtype=dtype)
+    array = numpy.array(pixels)
+    if array.dtype.kind not in 'iuf':
+        array = array.astype(numpy.float64)
+    return array
+
+
+def from_array(image, array):
+    """
+    Builds a new image the same size as the given image, holding the values
+    of array in the same kind of container as the given image's pixels
+    """
+    if isinstance(image['pixels'], list):
+        pixels = array.tolist()
+        if array.ndim == 2:
+            pixels = [tuple(color) for color in pixels]
+    elif array.ndim == 2:
+        pixels = lab.ColorPixels(array.astype(numpy.uint8).tobytes())
+    elif array.dtype.kind in 'iu' and (array.size == 0 or
+                                      (array.min() >= 0 and array.max() <= 255)):
+        pixels = bytearray(array.astype(numpy.uint8).tobytes())
+    elif array.dtype.kind in 'iu':
+        pixels = lab.NumberPixels(array.astype(numpy.int64).tobytes(), 'q')
+    else:
+        pixels = lab.NumberPixels(array.astype(numpy.float64).tobytes(), 'd')
+    return {'height': image['height'], 'width': image['width'], 'pixels': pixels}
+
+
+def inverted(image):
+    """
+    Reverses the grayscale value of each pixel
+    """
+    return from_array(image, 255 - to_array(image['pixels']))
+
+
+def scaled(image, n):
+    """
+    Multiplies the grayscale value of each pixel by n
+    """
+    return from_array(image, to_array(image['pixels']) * n)
+
+
+def correlate(image, kernel, boundary_behavior):
+    """
+    Compute the result of correlating the given image with the given kernel,
+    exactly as lab.correlate does (including its separable fast path).
+    """
+    if boundary_behavior not in NUMPY_PAD_MODES:
+        return None
+
+    height, width = image['height'], image['width']
+    pixels = to_array(image['pixels']).reshape(height, width)
+    pad_mode = NUMPY_PAD_MODES[boundary_behavior]
+
+    largest = None
+    if pixels.dtype.kind in 'iu':
+        largest = int(numpy.abs(pixels).max()) if pixels.size else 0
+    factors = lab.exact_separable_factors(kernel, largest)
+    if factors is not None:
+        column, row = factors
+        row_range = len(row) // 2
+        padded = numpy.pad(pixels, ((0, 0), (row_range, len(row) - row_range - 1)),
+                           mode=pad_mode)
+        horizontal = numpy.zeros((height, width), dtype=numpy.int64)
+        for kern_x, scale_factor in enumerate(row):
+            if scale_factor != 0:
+                horizontal = horizontal + padded[:, kern_x:kern_x+width]*scale_factor
+
+        column_range = len(column) // 2
+        padded = numpy.pad(horizontal,
+                           ((column_range, len(column) - column_range - 1), (0, 0)),
+                           mode=pad_mode)
+        result = numpy.zeros((height, width), dtype=numpy.int64)
+        for kern_y, scale_factor in enumerate(column):
+            if scale_factor != 0:
+                result = result + padded[kern_y:kern_y+height, :]*scale_factor
+    else:
+        kernel_height, kernel_width = len(kernel), len(kernel[0])
+        y_range, x_range = kernel_height // 2, kernel_width // 2
+        padded = numpy.pad(pixels, ((y_range, kernel_height - y_range - 1),
+                                    (x_range, kernel_width - x_range - 1)),
+                           mode=pad_mode)
+        result = numpy.zeros((height, width), dtype=numpy.int64)
+        for kern_y in range(kernel_height):
+            for kern_x in range(kernel_width):
+                scale_factor = kernel[kern_y][kern_x]
+                if scale_factor != 0:
+                    result = result + \
+                        padded[kern_y:kern_y+height, kern_x:kern_x+width]*scale_factor
+
+    return from_array(image, result.reshape(-1))
+
+
+def round_and_clip_image(image):
+    """
+    Given an image, returns a new image with all values rounded (half to even,
+    like Python's round) and clipped to integers in the range [0, 255]
+    """
+    values = to_array(image['pixels'])
+    return from_array(image, numpy.clip(numpy.round(values), 0, 255)
+                      .astype(numpy.int64))
+
+
+def edges(image):
+    """
+    Return a new image representing the result of applying an edge detection
+    filter to the given input image, using 'extend' boundary behavior.
+    """
+    kernel_x = [[-1, 0, 1],
+                [-2, 0, 2],
+                [-1, 0, 1]]
+    kernel_y = [[-1, -2, -1],
+                [0,  0,  0],
+                [1,  2,  1]]
+    gradient_x = to_array(correlate(image, kernel_x, 'extend')['pixels'])
+    gradient_y = to_array(correlate(image, kernel_y, 'extend')['pixels'])
+    magnitude = numpy.sqrt((gradient_x**2 + gradient_y**2).astype(numpy.float64))
+    return from_array(image, numpy.clip(numpy.round(magnitude), 0, 255)
+                      .astype(numpy.int64))
+
+
+def split_to_grayscale(image):
+    """
+    Takes an RGB image and returns 3 grayscale images, one per color layer
+    """
+    colors = to_array(image['pixels']).reshape(-1, 3)
+    return tuple(from_array(image, colors[:, layer]) for layer in range(3))
+
+
+def merge_to_color(red_layer, green_layer, blue_layer):
+    """
+    Merges 3 grayscale images into one RGB image
+    """
+    layers = [to_array(layer['pixels']) for layer in
+              (red_layer, green_layer, blue_layer)]
+    return from_array(red_layer, numpy.stack(layers, axis=1))
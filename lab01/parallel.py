@@ -0,0 +1,190 @@
+"""
+Multi-process versions of the lab's neighborhood filters for large images.
+
+The image is split into bands of rows.  Each band is extended with enough
+"halo" rows above and below it for the kernel to reach (filled in according
+to the boundary behavior, exactly as lab.correlate would see them), filtered
+in a worker process with the ordinary functions from lab.py, and written
+back into place.  Input and output pixels live in shared memory, so workers
+only receive a few integers and names, not pickled pixel lists.
+
+Every output pixel is computed by the same arithmetic, in the same order, as
+in a single process, so the results are identical to lab.correlate,
+lab.blurred, lab.sharpened, lab.gaussian_blurred and lab.edges for every
+boundary behavior.
+"""
+
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import lab
+
+
+def halo(op, args):
+    """
+    Returns the number of rows above and below each output row that the given
+    operation reads
+    """
+    if op == 'correlate':
+        size = len(args[0])
+    elif op == 'gaussian_blurred':
+        return lab.filter_reach(('gaussian', args[0]))
+    elif op == 'edges':
+        size = 3
+    else:
+        size = args[0]
+    return size // 2, size - size // 2 - 1
+
+
+def filter_band(task):
+    """
+    Runs in a worker process: filters rows y_start to y_stop of the shared
+    input image and writes them into the shared output image
+    """
+    (op, args, boundary_behavior, width, height, y_start, y_stop,
+     in_name, in_format, out_name, out_format) = task
+    top, bottom = halo(op, args)
+    in_size = 1 if in_format == 'B' else 8
+    out_size = 1 if out_format == 'B' else 8
+
+    in_memory = shared_memory.SharedMemory(name=in_name)
+    try:
+        rows = []
+        zero_row = [0]*width
+        for y in range(y_start - top, y_stop + bottom):
+            source_y = lab.boundary_index(y, height, boundary_behavior)
+            if source_y is None:
+                rows.append(zero_row)
+                continue
+            start = source_y*width*in_size
+            row = in_memory.buf[start:start + width*in_size]
+            rows.append(list(row) if in_format == 'B' else row.cast('d').tolist())
+            row.release()
+    finally:
+        in_memory.close()
+
+    band = {'height': len(rows), 'width': width,
+            'pixels': [pix for row in rows for pix in row]}
+    if op == 'correlate':
+        result = lab.correlate(band, args[0], boundary_behavior)
+    else:
+        result = getattr(lab, op)(band, *args)
+    values = result['pixels'][top*width:(top + y_stop - y_start)*width]
+    data = bytes(values) if out_format == 'B' else array('d', values).tobytes()
+
+    out_memory = shared_memory.SharedMemory(name=out_name)
+    try:
+        start = y_start*width*out_size
+        out_memory.buf[start:start + len(data)] = data
+    finally:
+        out_memory.close()
+
+
+def run_in_bands(op, args, image, boundary_behavior, out_format,
+                 workers=None, band_rows=None, executor=None):
+    """
+    Applies lab.<op>(image, *args) (or lab.correlate for 'correlate') by
+    filtering bands of rows in parallel worker processes.
+
+    Parameters:
+      * op (str) : 'correlate', 'blurred', 'sharpened', 'gaussian_blurred'
+            or 'edges'
+      * args (tuple) : the arguments after the image (the kernel for
+            'correlate', the kernel size for blurred and sharpened, sigma
+            for gaussian_blurred)
+      * image (dict) : a grayscale image (with a list or compact pixels)
+      * boundary_behavior (str) : how rows beyond the top and bottom edges
+            are filled in
+      * out_format (str) : 'B' if the results are integers in [0, 255], 'd'
+            if they are arbitrary numbers
+      * workers (int) : the number of processes (defaults to the number of
+            CPUs); ignored if executor is given
+      * band_rows (int) : the number of rows per band (defaults to enough
+            bands for 4 per worker)
+      * executor (ProcessPoolExecutor) : an existing pool to run the bands on
+    Returns:
+      The filtered image, with pixels in the same kind of container as the
+      input image
+    """
+    width, height = image['width'], image['height']
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if band_rows is None:
+        band_rows = max(1, -(-height // (4*workers)))
+
+    data = lab.pixel_bytes(image['pixels'])
+    in_format = 'B' if data is not None else 'd'
+    if data is None:
+        data = array('d', image['pixels']).tobytes()
+    out_size = 1 if out_format == 'B' else 8
+
+    in_memory = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    out_memory = shared_memory.SharedMemory(create=True,
+                                            size=max(1, width*height*out_size))
+    try:
+        in_memory.buf[:len(data)] = data
+        tasks = [(op, args, boundary_behavior, width, height,
+                  y_start, min(height, y_start + band_rows),
+                  in_memory.name, in_format, out_memory.name, out_format)
+                 for y_start in range(0, height, band_rows)]
+        if executor is None:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(filter_band, tasks))
+        else:
+            list(executor.map(filter_band, tasks))
+        result = bytes(out_memory.buf[:width*height*out_size])
+    finally:
+        in_memory.close()
+        in_memory.unlink()
+        out_memory.close()
+        out_memory.unlink()
+
+    if out_format == 'B':
+        pixels = list(result) if isinstance(image['pixels'], list) else bytearray(result)
+    elif isinstance(image['pixels'], list):
+        pixels = memoryview(result).cast('d').tolist()
+    else:
+        pixels = lab.NumberPixels(result, 'd')
+    return {'height': height, 'width': width, 'pixels': pixels}
+
+
+def correlate(image, kernel, boundary_behavior, **options):
+    """
+    Parallel version of lab.correlate.  Takes the same options as
+    run_in_bands (workers, band_rows, executor).
+    """
+    if boundary_behavior not in ('zero', 'extend', 'wrap'):
+        return None
+    return run_in_bands('correlate', (kernel,), image, boundary_behavior, 'd',
+                        **options)
+
+
+def blurred(image, n, **options):
+    """
+    Parallel version of lab.blurred
+    """
+    return run_in_bands('blurred', (n,), image, 'extend', 'B', **options)
+
+
+def sharpened(image, n, **options):
+    """
+    Parallel version of lab.sharpened
+    """
+    return run_in_bands('sharpened', (n,), image, 'extend', 'B', **options)
+
+
+def gaussian_blurred(image, sigma, **options):
+    """
+    Parallel version of lab.gaussian_blurred
+    """
+    return run_in_bands('gaussian_blurred', (sigma,), image, 'extend', 'B',
+                        **options)
+
+
+def edges(image, **options):
+    """
+    Parallel version of lab.edges
+    """
+    return run_in_bands('edges', (), image, 'extend', 'B', **options)
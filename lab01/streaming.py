@@ -0,0 +1,239 @@
+"""
+Row-streaming versions of the lab's loading, filtering and saving functions,
+for images too large to hold as a list of pixels.
+
+Images are read a strip of rows at a time, filtered over a rolling window of
+rows, and written out as each strip of output rows is finished, so only a
+window of (strip + kernel size) rows of Python pixels is ever held at once.
+
+Binary PGM/PPM files are read and written straight from and to disk, row by
+row.  Other formats are decoded by PIL, which keeps the decoded image in its
+own compact buffer (1 or 3 bytes per pixel); rows are still converted to
+Python values one strip at a time.  PNG output is compressed incrementally.
+
+Filters must be ones with a `spec` (see lab.filter_from_spec) whose reach is
+known from lab.filter_reach, and whose boundary behavior is 'extend' or
+'zero'.  Every filter in lab.py qualifies.  Each window holds all of the real
+rows that the output strip depends on, so results are identical to filtering
+the whole image at once.
+"""
+
+import struct
+import zlib
+
+from PIL import Image
+
+import lab
+
+
+NETPBM_MODES = {b'P5': 1, b'P6': 3}
+
+
+def read_netpbm_header(handle):
+    """
+    Reads the header of a binary PGM/PPM file, returning a tuple (magic,
+    width, height, maxval) with the file positioned at the first pixel, or
+    None if the file does not start with such a header
+    """
+    tokens = []
+    token = b''
+    while len(tokens) < 4:
+        char = handle.read(1)
+        if char == b'#' and not token:
+            handle.readline()
+        elif char.isspace() or not char:
+            if token:
+                tokens.append(token)
+                token = b''
+            if not char:
+                return None
+        elif len(token) >= 2 and not tokens:
+            return None
+        else:
+            token += char
+        if tokens and tokens[0] not in NETPBM_MODES:
+            return None
+    return tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3])
+
+
+def color_row(data):
+    """
+    Converts interleaved RGB bytes into a row of (r, g, b) tuples
+    """
+    return list(zip(data[0::3], data[1::3], data[2::3]))
+
+
+def greyscale_row(data, channels):
+    """
+    Converts bytes with the given number of channels (1 for greyscale, 3 for
+    RGB) into a row of greyscale values, as load_greyscale_image does
+    """
+    if channels == 1:
+        return list(data)
+    return [round(.299 * r + .587 * g + .114 * b) for r, g, b in
+            zip(data[0::3], data[1::3], data[2::3])]
+
+
+class RowReader:
+    """
+    Reads an image file one row at a time.
+
+    Attributes:
+      * width, height (int) : the size of the image
+      * color (bool) : whether rows hold (r, g, b) tuples rather than
+            greyscale values
+
+    Iterating over a RowReader yields the rows of the image, top to bottom,
+    each as a list of pixels.  Use it as a context manager to close the file.
+    """
+    def __init__(self, filename, color=False, strip_rows=64):
+        self.color = color
+        self.strip_rows = strip_rows
+        self.handle = open(filename, 'rb')
+        self.image = None
+        header = read_netpbm_header(self.handle)
+        if header is not None and header[3] == 255:
+            magic, self.width, self.height, _ = header
+            self.channels = NETPBM_MODES[magic]
+        else:
+            self.handle.seek(0)
+            self.image = Image.open(self.handle)
+            self.width, self.height = self.image.size
+
+    def __iter__(self):
+        if self.image is None:
+            row_size = self.width*self.channels
+            for _ in range(self.height):
+                data = self.handle.read(row_size)
+                if len(data) != row_size:
+                    raise ValueError('Image data ended early')
+                if self.color:
+                    yield (color_row(data) if self.channels == 3 else
+                           [(v, v, v) for v in data])
+                else:
+                    yield greyscale_row(data, self.channels)
+            return
+        for y_start in range(0, self.height, self.strip_rows):
+            y_stop = min(self.height, y_start + self.strip_rows)
+            strip = self.image.crop((0, y_start, self.width, y_stop))
+            if self.color:
+                data = strip.convert('RGB').tobytes()
+                row_size = 3*self.width
+            else:
+                data = lab.greyscale_bytes_from_image(strip)
+                row_size = self.width
+            for start in range(0, len(data), row_size):
+                row = data[start:start+row_size]
+                yield color_row(row) if self.color else list(row)
+
+    def close(self):
+        if self.image is not None:
+            self.image.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def png_chunk(kind, data):
+    """
+    Returns the bytes of a PNG chunk of the given kind
+    """
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data)))
+
+
+def write_rows(filename, width, height, rows, color=False):
+    """
+    Writes the given rows (an iterable of lists of pixels, top to bottom) to
+    an 8-bit image file as they arrive.  The format is chosen from the file
+    name: '.pgm'/'.ppm' for binary netpbm, '.png' for PNG.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension not in ('pgm', 'ppm', 'png'):
+        raise ValueError('Cannot stream images to %r' % filename)
+    with open(filename, 'wb') as handle:
+        if extension == 'png':
+            handle.write(b'\x89PNG\r\n\x1a\n')
+            handle.write(png_chunk(b'IHDR', struct.pack(
+                '>IIBBBBB', width, height, 8, 2 if color else 0, 0, 0, 0)))
+            compressor = zlib.compressobj()
+        else:
+            handle.write(b'P6' if color else b'P5')
+            handle.write(b'\n%d %d\n255\n' % (width, height))
+        written = 0
+        for row in rows:
+            data = bytes(v for pix in row for v in pix) if color else bytes(row)
+            if extension == 'png':
+                compressed = compressor.compress(b'\x00' + data)
+                if compressed:
+                    handle.write(png_chunk(b'IDAT', compressed))
+            else:
+                handle.write(data)
+            written += 1
+        if written != height:
+            raise ValueError('Expected %d rows, got %d' % (height, written))
+        if extension == 'png':
+            handle.write(png_chunk(b'IDAT', compressor.flush()))
+            handle.write(png_chunk(b'IEND', b''))
+
+
+def cascade_reach(filters):
+    """
+    Returns the total number of rows (above, below) that the given filters,
+    applied in order, read around each output row
+    """
+    above = below = 0
+    for filt in filters:
+        spec = getattr(filt, 'spec', None)
+        reach = lab.filter_reach(spec) if spec is not None else None
+        if reach is None:
+            raise ValueError('Cannot stream a filter without a known reach')
+        above += reach[0]
+        below += reach[1]
+    return above, below
+
+
+def filter_rows(rows, width, height, filters, strip_rows=None):
+    """
+    Applies the given filters, in order, to an image given as an iterable of
+    rows, yielding the rows of the result.  At most strip_rows output rows
+    plus the filters' reach are held at once; strip_rows defaults to 64, or
+    the total reach plus one if that is larger.
+    """
+    above, below = cascade_reach(filters)
+    if strip_rows is None:
+        strip_rows = max(64, above + below + 1)
+    cascade = lab.filter_cascade(filters)
+    rows = iter(rows)
+    window = []
+    window_start = 0
+    for y_start in range(0, height, strip_rows):
+        y_stop = min(height, y_start + strip_rows)
+        first = max(0, y_start - above)
+        del window[:first - window_start]
+        window_start = first
+        while window_start + len(window) < min(height, y_stop + below):
+            window.append(next(rows))
+        result = cascade({'height': len(window), 'width': width,
+                          'pixels': [pix for row in window for pix in row]})
+        pixels = result['pixels']
+        for y in range(y_start - window_start, y_stop - window_start):
+            yield list(pixels[y*width:(y+1)*width])
+
+
+def stream_filter(in_filename, out_filename, filters, color=False,
+                  strip_rows=None):
+    """
+    Loads the image in in_filename (as greyscale, or as color if color is
+    True), applies the given filters in order, and saves the result to
+    out_filename (see write_rows), streaming rows the whole way through.
+    """
+    with RowReader(in_filename, color) as reader:
+        write_rows(out_filename, reader.width, reader.height,
+                   filter_rows(reader, reader.width, reader.height, filters,
+                               strip_rows),
+                   color)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import os
+import math
+import copy
 import pickle
 import hashlib
 
@@ -83,6 +85,26 @@ def test_inverted_2():
     result = lab.inverted(im)
     expected = {'height': 1, 'width': 4, 'pixels': [238,166,104,38]}
 
+def test_lookup_tables():
+    im = {'height': 1, 'width': 6, 'pixels': [0, 1, 100, 127, 128, 255]}
+    for n in (0, 0.3, 0.5, 1, 1.5, 2):
+        expected = lab.round_and_clip_image(lab.scaled(im, n))
+        assert lab.apply_lut(im, lab.clipped_scale_lut(n)) == expected
+    assert lab.apply_lut(im, lab.INVERTED_LUT) == {'height': 1, 'width': 6, 'pixels': [255, 254, 155, 128, 127, 0]}
+    assert lab.apply_lut({'height': 1, 'width': 2, 'pixels': [0, 2.0]}, lab.INVERTED_LUT) is None
+    assert lab.apply_lut({'height': 1, 'width': 2, 'pixels': [0, 256]}, lab.INVERTED_LUT) is None
+    assert lab.apply_lut({'height': 1, 'width': 2, 'pixels': [-1, 2]}, lab.INVERTED_LUT) is None
+    assert lab.inverted({'height': 1, 'width': 3, 'pixels': [-1, 2.5, 300]})['pixels'] == [256, 252.5, -45]
+
+    color = lab.load_color_image('test_images/centered_pixel_color.png', compact=True)
+    color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
+    luts = lab.optimize_filters([color_inverted, lab.color_scale_filter(1.5, 1, 0.5), color_inverted])
+    assert len(luts) == 1
+    result = luts[0](color)
+    assert isinstance(result['pixels'], lab.ColorPixels)
+    assert lab.get_pixel(result, 0, 0) == (255-round(11*1.5), 255-82, 255-round(57*0.5))
+
+
 def test_correlate_identity():
     im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
     kernel = [[0, 0, 0],
@@ -132,6 +154,145 @@ def test_correlate_translate():
     # print(result)
     compare_greyscale_images(result, expected)
 
+def correlate_reference(im, kernel, boundary_behavior):
+    # direct 2D correlation, one get_pixel_new call per kernel tap
+    y_range, x_range = len(kernel) // 2, len(kernel[0]) // 2
+    pixels = []
+    for y in range(im['height']):
+        for x in range(im['width']):
+            pixels.append(sum(lab.get_pixel_new(im, x+kx-x_range, y+ky-y_range, boundary_behavior)*kernel[ky][kx]
+                              for ky in range(len(kernel)) for kx in range(len(kernel[0]))))
+    return {'height': im['height'], 'width': im['width'], 'pixels': pixels}
+
+
+def test_separate_kernel():
+    assert lab.separate_kernel(lab.create_blur_kernel(5)) is not None
+    assert lab.separate_kernel([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]) == ([-1, -2, -1], [1, 0, -1])
+    assert lab.separate_kernel([[-1, -2, -1], [0, 0, 0], [1, 2, 1]]) == ([-1, 0, 1], [1, 2, 1])
+    assert lab.separate_kernel([[0, 1, 0], [1, 1, 1], [0, 1, 0]]) is None
+    assert lab.separate_kernel([[0, 0], [0, 0]]) is None
+
+
+def test_integer_kernel():
+    assert lab.rational_weight(1/9) == (1, 9)
+    assert lab.rational_weight(-0.125) == (-1, 8)
+    assert lab.rational_weight(3) == (3, 1)
+    assert lab.rational_weight(math.pi) is None
+    assert lab.integer_kernel(lab.create_blur_kernel(3)) == ([[1]*3]*3, 9)
+    assert lab.integer_kernel([[1/3, 0, -1/6], [0.2, 1, 0.1]]) == ([[10, 0, -5], [6, 30, 3]], 30)
+    assert lab.integer_kernel([[math.pi]]) is None
+    assert lab.separate_kernel([[3, 1], [6, 2]]) == ([1, 2], [3, 1])
+
+
+@pytest.mark.parametrize("boundary_behavior", ['zero', 'extend', 'wrap'])
+def test_correlate_and_round_matches_float(boundary_behavior):
+    im = {'height': 9, 'width': 13, 'pixels': [(53*i*i + 7*i) % 256 for i in range(117)]}
+    wide = {'height': 9, 'width': 13, 'pixels': [(53*i*i + 7*i) % 900 - 300 for i in range(117)]}
+    kernels = [lab.create_blur_kernel(4), lab.create_blur_kernel(5), [[0.25, 0.5], [0.125, 3]],
+               [[1/3, 0, -1/6], [0.2, 1, 0.1], [0, 0, 0.7]], [[0, 1, 0], [1, -4, 1], [0, 1, 0]],
+               [[0.5, 0], [0, 0.5]], [[math.pi]], [[0.2, 0, 0.1, 0.3]], [[0.25], [0.5], [1/3]]]
+    for image in (im, wide, lab.compact_image(im)):
+        for kernel in kernels:
+            expected = lab.round_and_clip_image(lab.correlate(image, kernel, boundary_behavior))
+            result = lab.correlate_and_round(image, kernel, boundary_behavior)
+            assert result == expected
+            assert type(result['pixels']) is type(expected['pixels'])
+            assert all(type(pix) is int for pix in result['pixels'])
+    assert lab.correlate_and_round(im, kernels[0], 'bogus') is None
+
+    color = lab.compact_image({'height': 9, 'width': 13, 'pixels': [
+        (pix, 255 - pix, pix // 2) for pix in im['pixels']]})
+    color_filter = lab.color_filter_from_greyscale_filter(lab.make_correlate_filter(kernels[3]))
+    assert isinstance(color_filter(color)['pixels'], lab.ColorPixels)
+
+
+def test_pad_image():
+    im = {'height': 2, 'width': 3, 'pixels': [1, 2, 3,
+                                              4, 5, 6]}
+    assert lab.pad_image(im, 1, 0, 1, 2, 'zero') == [[0, 0, 0, 0, 0, 0],
+                                                      [0, 1, 2, 3, 0, 0],
+                                                      [0, 4, 5, 6, 0, 0]]
+    assert lab.pad_image(im, 1, 0, 1, 2, 'extend') == [[1, 1, 2, 3, 3, 3],
+                                                        [1, 1, 2, 3, 3, 3],
+                                                        [4, 4, 5, 6, 6, 6]]
+    assert lab.pad_image(im, 1, 0, 1, 2, 'wrap') == [[6, 4, 5, 6, 4, 5],
+                                                      [3, 1, 2, 3, 1, 2],
+                                                      [6, 4, 5, 6, 4, 5]]
+
+
+@pytest.mark.parametrize("boundary_behavior", ['zero', 'extend', 'wrap'])
+@pytest.mark.parametrize("kernel", [lab.create_blur_kernel(3),
+                                    lab.create_blur_kernel(4),
+                                    lab.create_blur_kernel(6),
+                                    lab.create_blur_kernel(9),
+                                    lab.create_blur_kernel(10),
+                                    [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]],
+                                    [[-1, -2, -1], [0, 0, 0], [1, 2, 1]],
+                                    [[0, 1, 0], [1, -4, 1], [0, 1, 0]],
+                                    [[1, 2, 3, 4]],
+                                    [[1], [0], [-1]],
+                                    [[0.5, 0, 1], [1, -2, 0]],
+                                    [[1, 2], [3, 4], [5, 7]]])
+def test_correlate_separable_matches_2d(kernel, boundary_behavior):
+    im = {'height': 5, 'width': 7, 'pixels': [(37*i) % 256 for i in range(35)]}
+    oim = object_hash(im)
+    result = lab.correlate(im, kernel, boundary_behavior)
+    expected = correlate_reference(im, kernel, boundary_behavior)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+    assert result['height'] == expected['height'] and result['width'] == expected['width']
+    assert result['pixels'] == expected['pixels']
+
+
+@pytest.mark.parametrize("n", [4, 6, 10, 12])
+def test_box_blur_ties_match_2d(n):
+    # even kernels whose weight 1/n**2 is not exact: exact .5 ties round
+    # according to the row-major order of the 2D correlation
+    tiny = {'width': 3, 'height': 2, 'pixels': [59, 112, 190, 87, 170, 218]}
+    im = {'height': 11, 'width': 13, 'pixels': [(53*i*i + 7*i) % 256 for i in range(143)]}
+    if n == 6:
+        assert lab.blurred(tiny, 6)['pixels'][1] == 123
+    for image in (tiny, im, lab.compact_image(im)):
+        expected = correlate_reference(image, lab.create_blur_kernel(n), 'extend')
+        assert list(lab.blurred(image, n)['pixels']) == lab.round_and_clip_image(expected)['pixels']
+        sharp = [2*pix - blur for pix, blur in zip(image['pixels'], expected['pixels'])]
+        assert list(lab.sharpened(image, n)['pixels']) == lab.round_and_clip_image(
+            {'height': image['height'], 'width': image['width'], 'pixels': sharp})['pixels']
+
+
+
+def test_rectangular_kernels():
+    im = {'height': 6, 'width': 5, 'pixels': [(29*i) % 256 for i in range(30)]}
+    with pytest.raises(ValueError):
+        lab.correlate(im, [[1, 2], [3]], 'zero')
+    assert lab.convolve_kernels([[1, 2, 1]], [[1], [2], [1]]) == [[1, 2, 1], [2, 4, 2], [1, 2, 1]]
+    assert lab.filter_reach(('kernel', ((1,), (2,), (3,), (4,)))) == (2, 1)
+
+
+def test_gaussian_blurred():
+    assert lab.gaussian_kernel(0) == [1]
+    kernel = lab.gaussian_kernel(1.5)
+    assert len(kernel) == 13 and sum(kernel) == pytest.approx(1)
+    assert kernel == kernel[::-1] and max(kernel) == kernel[6]
+    for sigma in (3, 4.5, 10, 40):
+        sizes = lab.gaussian_box_sizes(sigma)
+        assert all(n % 2 == 1 for n in sizes) and max(sizes) - min(sizes) <= 2
+        assert sum((n*n - 1) / 12 for n in sizes) == pytest.approx(sigma**2, rel=0.15)
+
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    expected = lab.round_and_clip_image(correlate_reference(
+        im, [[a*b for b in kernel] for a in kernel], 'extend'))
+    assert lab.gaussian_blurred(im, 1.5) == expected
+    assert lab.filter_from_spec(('gaussian', 1.5))(lab.compact_image(im))['pixels'] == bytearray(expected['pixels'])
+    assert lab.gaussian_blurred(im, 0) == im
+
+    # large sigmas: repeated box blurs, whose cost does not depend on sigma
+    flat = {'height': 20, 'width': 30, 'pixels': [77]*600}
+    assert lab.gaussian_blurred(flat, 50) == flat
+    step = {'height': 4, 'width': 40, 'pixels': ([0]*20 + [200]*20)*4}
+    row = lab.gaussian_blurred(step, 5)['pixels'][:40]
+    assert row == sorted(row) and row[0] == 0 and row[-1] == 200 and row[19] + row[20] == 200
+    assert lab.filter_reach(('gaussian', 5)) == (sum(n // 2 for n in lab.gaussian_box_sizes(5)),)*2
+
 @pytest.mark.parametrize("fname", ['mushroom', 'twocats', 'chess'])
 def test_inverted_images(fname):
     inpfile = os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % fname)
@@ -231,6 +392,36 @@ def test_blurred_centered_pixel():
     compare_greyscale_images(result_2, expected_2)
 
 
+@pytest.mark.parametrize("kernsize", [1, 2, 4, 5, 6, 8, 12, 51])
+def test_blurred_running_sum_matches_correlate(kernsize):
+    im = {'height': 9, 'width': 13, 'pixels': [(53*i*i + 7*i) % 256 for i in range(117)]}
+    oim = object_hash(im)
+    kernel = lab.create_blur_kernel(kernsize)
+    expected = lab.round_and_clip_image(lab.correlate(im, kernel, 'extend'))
+    compare_greyscale_images(lab.blurred(im, kernsize), expected)
+
+    scaled = [2*p for p in im['pixels']]
+    unsharp = [i - b for i, b in zip(scaled, lab.correlate(im, kernel, 'extend')['pixels'])]
+    expected = lab.round_and_clip_image({'height': 9, 'width': 13, 'pixels': unsharp})
+    compare_greyscale_images(lab.sharpened(im, kernsize), expected)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+
+
+def test_blurred_float_pixels():
+    im = {'height': 2, 'width': 3, 'pixels': [0.5, 10.25, 3, 7, 100.75, 255]}
+    expected = lab.round_and_clip_image(lab.correlate(im, lab.create_blur_kernel(3), 'extend'))
+    compare_greyscale_images(lab.blurred(im, 3), expected)
+
+
+@pytest.mark.parametrize("kernsize", [2, 3, 4])
+def test_sharpened_out_of_range_pixels(kernsize):
+    im = {'height': 4, 'width': 5, 'pixels': [(97*i*i) % 900 - 300 for i in range(20)]}
+    blurred = lab.correlate(im, lab.create_blur_kernel(kernsize), 'extend')['pixels']
+    unsharp = [2*p - b for p, b in zip(im['pixels'], blurred)]
+    expected = lab.round_and_clip_image({'height': 4, 'width': 5, 'pixels': unsharp})
+    compare_greyscale_images(lab.sharpened(im, kernsize), expected)
+
+
 @pytest.mark.parametrize("kernsize", [1, 3, 9])
 @pytest.mark.parametrize("fname", ['mushroom', 'twocats', 'chess'])
 def test_sharpened_images(kernsize, fname):
@@ -279,6 +470,21 @@ def test_edges_centered_pixel():
     compare_greyscale_images(result, expected)
 
 
+def test_edges_fused_matches_correlate():
+    assert list(lab.SOBEL_MAGNITUDES) == [min(255, round(math.sqrt(s))) for s in range(255*255)]
+    kx = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
+    ky = [[-1, -2, -1], [0, 0, 0], [1, 2, 1]]
+    for height, width in [(1, 1), (1, 6), (5, 1), (2, 3), (9, 7)]:
+        im = {'height': height, 'width': width,
+              'pixels': [(97*i*i - 41*i) % 700 - 200 for i in range(height*width)]}
+        ox = lab.correlate(im, kx, 'extend')['pixels']
+        oy = lab.correlate(im, ky, 'extend')['pixels']
+        expected = [min(255, round(math.sqrt(x**2 + y**2))) for x, y in zip(ox, oy)]
+        assert lab.edges(im)['pixels'] == expected
+        float_im = {'height': height, 'width': width, 'pixels': [float(pix) for pix in im['pixels']]}
+        assert lab.edges(float_im)['pixels'] == expected
+
+
 def test_load_color():
     result = lab.load_color_image('test_images/centered_pixel_color.png')
     expected = {
@@ -299,6 +505,24 @@ def test_load_color():
     compare_color_images(result, expected)
 
 
+
+def test_greyscale_conversion_rounding(tmp_path):
+    # a spread of colors that includes many whose luminance lies within a
+    # hair of a rounding boundary
+    colors = [(r, g, b) for r in range(256) for g in range(0, 256, 7)
+              for b in range(0, 256, 11)]
+    expected = [round(.299 * r + .587 * g + .114 * b) for r, g, b in colors]
+    im = {'height': len(colors) // 256, 'width': 256, 'pixels': colors}
+    infile = str(tmp_path / 'colors.png')
+    lab.save_color_image(im, infile)
+    assert lab.load_color_image(infile) == im
+    assert lab.load_greyscale_image(infile)['pixels'] == expected
+    assert lab.load_greyscale_image(infile, compact=True)['pixels'] == bytearray(expected)
+
+    outfile = str(tmp_path / 'grey.png')
+    lab.save_greyscale_image(lab.load_greyscale_image(infile), outfile)
+    assert lab.load_greyscale_image(outfile)['pixels'] == expected
+
 def test_color_filter_inverted():
     im = lab.load_color_image('test_images/centered_pixel_color.png')
     color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
@@ -417,6 +641,335 @@ def test_color_sharpen_filter_images(fname, ker_size):
     compare_color_images(result, expected)
 
 
+def test_compact_greyscale_filters():
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png')
+    im = lab.load_greyscale_image(inpfile)
+    cim = lab.load_greyscale_image(inpfile, compact=True)
+    assert isinstance(cim['pixels'], bytearray) and len(cim['pixels']) == 11*11
+    assert lab.expand_image(cim) == im
+    assert lab.get_pixel(cim, 5, 5) == 255
+    for filt in (lab.inverted, lab.edges, lab.make_blur_filter(3), lab.make_sharpen_filter(3)):
+        result = filt(cim)
+        assert isinstance(result['pixels'], bytearray)
+        compare_greyscale_images(lab.expand_image(result), filt(im))
+    assert lab.get_pixel(cim, 5, 5) == 255, 'Be careful not to modify the original image!'
+
+    result = lab.correlate(cim, [[0, 0, 0], [0, 0.5, 0], [0, 0, 0]], 'zero')
+    assert isinstance(result['pixels'], lab.NumberPixels) and result['pixels'].typecode == 'd'
+    assert list(result['pixels']) == lab.correlate(im, [[0, 0, 0], [0, 0.5, 0], [0, 0, 0]], 'zero')['pixels']
+    object_hash(result)
+    assert pickle.loads(pickle.dumps(result)) == result == copy.deepcopy(result)
+
+    # integers outside [0, 255] stay integers
+    doubled = lab.scaled(cim, 2)
+    assert isinstance(doubled['pixels'], lab.NumberPixels) and doubled['pixels'].typecode == 'q'
+    assert lab.get_pixel(doubled, 5, 5) == 510 and isinstance(lab.get_pixel(doubled, 5, 5), int)
+    assert list(doubled['pixels']) == lab.scaled(im, 2)['pixels']
+    doubled['pixels'][0] = 0.5
+    assert doubled['pixels'].typecode == 'd' and doubled['pixels'][:2] == lab.compact_pixels([0.5, 0.0])
+    assert lab.compact_pixels([2**70, 1]) == [2**70, 1]
+
+
+def test_compact_color_images(tmp_path):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel_color.png')
+    im = lab.load_color_image(inpfile)
+    cim = lab.load_color_image(inpfile, compact=True)
+    assert len(cim['pixels'].data) == 3*11*11
+    assert lab.expand_image(cim) == im
+    assert lab.expand_image(lab.compact_image(im)) == im
+    assert lab.get_pixel(cim, 5, 5) == (253, 253, 149)
+    assert lab.compact_image(im) == lab.compact_image(im) == cim
+    assert lab.compact_image(im) != lab.compact_image(lab.color_scale_filter(0.5)(im))
+    with pytest.raises(IndexError):
+        cim['pixels'][11*11]
+    with pytest.raises(IndexError):
+        cim['pixels'][-11*11-1] = (1, 2, 3)
+
+    filt = lab.filter_cascade([lab.color_filter_from_greyscale_filter(lab.edges),
+                               lab.color_filter_from_greyscale_filter(lab.inverted),
+                               lab.color_scale_filter(2, 0.3, 1)])
+    result = filt(cim)
+    assert isinstance(result['pixels'], lab.ColorPixels)
+    compare_color_images(lab.expand_image(result), filt(im))
+
+    lab.set_pixel(cim, 0, 0, (1, 2, 3))
+    outfile = str(tmp_path / 'out.png')
+    lab.save_color_image(cim, outfile)
+    assert lab.load_color_image(outfile) == lab.expand_image(cim)
+    lab.save_greyscale_image(lab.inverted(lab.load_greyscale_image(inpfile, compact=True)), outfile)
+    assert lab.load_greyscale_image(outfile) == lab.inverted(lab.load_greyscale_image(inpfile))
+
+
+@pytest.fixture
+def numpy_backend():
+    import numpy_backend
+    if not numpy_backend.enable():
+        pytest.skip('NumPy is not installed')
+    yield numpy_backend
+    numpy_backend.disable()
+
+
+@pytest.mark.parametrize("fname", ['mushroom', 'twocats', 'chess'])
+def test_numpy_backend_images(fname, numpy_backend):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % fname)
+    input_img = lab.load_greyscale_image(inpfile)
+    input_hash = object_hash(input_img)
+    for result, expname in [(lab.inverted(input_img), 'invert'),
+                            (lab.blurred(input_img, 7), 'blur_07'),
+                            (lab.sharpened(input_img, 3), 'sharp_03'),
+                            (lab.edges(input_img), 'edges')]:
+        expfile = os.path.join(TEST_DIRECTORY, 'test_results', '%s_%s.png' % (fname, expname))
+        compare_greyscale_images(result, lab.load_greyscale_image(expfile))
+    assert object_hash(input_img) == input_hash, "Be careful not to modify the original image!"
+
+
+@pytest.mark.parametrize("boundary_behavior", ['zero', 'extend', 'wrap'])
+def test_numpy_backend_matches_python(boundary_behavior, numpy_backend):
+    im = {'height': 5, 'width': 7, 'pixels': [(37*i) % 256 for i in range(35)]}
+    kernels = [lab.create_blur_kernel(4), [[0, 1, 0], [1, -4, 1], [0, 1, 0]], [[0.25, 0.5], [0.125, 3]]]
+    results = [lab.correlate(im, kernel, boundary_behavior) for kernel in kernels]
+    results.append(lab.blurred(im, 6))
+    results.append(lab.merge_to_color(*lab.split_to_grayscale(lab.load_color_image('test_images/centered_pixel_color.png'))))
+    numpy_backend.disable()
+    assert results[:3] == [lab.correlate(im, kernel, boundary_behavior) for kernel in kernels]
+    assert results[3] == lab.blurred(im, 6)
+    assert results[4] == lab.load_color_image('test_images/centered_pixel_color.png')
+
+
+def test_color_blur_numpy_backend(numpy_backend):
+    test_color_blur_filter_images('cat', 5)
+    test_color_sharpen_filter_images('bluegill', 3)
+
+
+@pytest.mark.parametrize("boundary_behavior", ['zero', 'extend', 'wrap'])
+def test_parallel_bands_match_single_process(boundary_behavior):
+    import parallel
+    from concurrent.futures import ProcessPoolExecutor
+    im = {'height': 13, 'width': 7, 'pixels': [(37*i) % 256 for i in range(91)]}
+    fim = {'height': 13, 'width': 7, 'pixels': [i/3 for i in range(91)]}
+    kernels = [lab.create_blur_kernel(4), [[0, 1, 0], [1, -4, 1], [0, 1, 0]],
+               [[0.25, 0.5], [0.125, 3]], lab.create_blur_kernel(31)]
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        for kernel in kernels:
+            for image in (im, fim, lab.compact_image(im)):
+                result = parallel.correlate(image, kernel, boundary_behavior,
+                                            band_rows=3, executor=pool)
+                assert list(result['pixels']) == list(lab.correlate(image, kernel, boundary_behavior)['pixels'])
+        assert parallel.blurred(im, 6, band_rows=2, executor=pool) == lab.blurred(im, 6)
+        assert parallel.sharpened(im, 3, band_rows=4, executor=pool) == lab.sharpened(im, 3)
+        assert parallel.edges(im, band_rows=5, executor=pool) == lab.edges(im)
+        result = parallel.blurred(lab.compact_image(im), 5, executor=pool)
+        assert isinstance(result['pixels'], bytearray)
+        assert lab.expand_image(result) == lab.blurred(im, 5)
+    assert parallel.correlate(im, kernels[0], 'bogus') is None
+
+
+def test_streaming_filters_match_whole_image(tmp_path):
+    import streaming
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'twocats.png')
+    im = lab.load_greyscale_image(inpfile)
+    for filters in ([lab.make_blur_filter(5)], [lab.make_sharpen_filter(4)], [lab.edges],
+                    [lab.edges, lab.inverted, lab.make_blur_filter(6), lab.make_correlate_filter([[0, 1], [2, 0]])]):
+        expected = im
+        for filt in filters:
+            expected = filt(expected)
+        outfile = str(tmp_path / 'out.png')
+        streaming.stream_filter(inpfile, outfile, filters, strip_rows=7)
+        assert lab.load_greyscale_image(outfile) == expected
+
+    # netpbm files are read and written row by row
+    pgmfile = str(tmp_path / 'out.pgm')
+    rows = [im['pixels'][y*im['width']:(y+1)*im['width']] for y in range(im['height'])]
+    streaming.write_rows(pgmfile, im['width'], im['height'], rows)
+    with streaming.RowReader(pgmfile) as reader:
+        assert reader.image is None
+        assert [pix for row in reader for pix in row] == im['pixels']
+
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel_color.png')
+    filters = [lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)), lab.color_scale_filter(2, 0.3, 1)]
+    expected = lab.filter_cascade(filters)(lab.load_color_image(inpfile))
+    for outfile in ('out.ppm', 'out.png'):
+        outfile = str(tmp_path / outfile)
+        streaming.stream_filter(inpfile, outfile, filters, color=True, strip_rows=2)
+        assert lab.load_color_image(outfile) == expected
+    with streaming.RowReader(outfile[:-3] + 'ppm', color=True) as reader:
+        assert [pix for row in reader for pix in row] == expected['pixels']
+
+    with pytest.raises(ValueError):
+        streaming.stream_filter(inpfile, outfile, [lambda image: image])
+
+
+def test_filter_cache(tmp_path):
+    import cache
+    calls = []
+    def counted(filt):
+        def counted_filter(image):
+            calls.append(filt.spec)
+            return filt(image)
+        counted_filter.spec = filt.spec
+        return counted_filter
+
+    edges = counted(lab.color_filter_from_greyscale_filter(lab.edges))
+    blur = counted(lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)))
+    scale = counted(lab.color_scale_filter(2, 0.3, 1))
+    im = lab.load_color_image('test_images/centered_pixel_color.png')
+    expected = lab.filter_cascade([edges, blur, scale])(im)
+    del calls[:]
+
+    results = cache.FilterCache(str(tmp_path), max_bytes=10**6)
+    assert results.filter_cascade([edges, blur])(im) == lab.filter_cascade([edges, blur])(im)
+    assert len(calls) == 4
+    del calls[:]
+    result = results.filter_cascade([edges, blur, scale])(im)
+    assert result == expected and calls == [scale.spec], 'should resume from the cached prefix'
+    result['pixels'][0] = (1, 2, 3)
+    assert results.filter_cascade([edges, blur, scale])(im) == expected
+    assert len(calls) == 1
+
+    # results are found on disk, for compact images too
+    results = cache.FilterCache(str(tmp_path))
+    compact = results.filter_cascade([edges, blur, scale])(lab.compact_image(im))
+    assert isinstance(compact['pixels'], lab.ColorPixels) and lab.expand_image(compact) == expected
+    assert len(calls) == 1
+
+    # the least recently used results are dropped from memory
+    results = cache.FilterCache(max_bytes=2*3*11*11)
+    for filt in (edges, blur, scale):
+        results.cached(filt)(im)
+    assert len(results.memory) == 2
+    assert cache.image_digest(im) == cache.image_digest(lab.compact_image(im))
+    assert cache.image_digest(im) != cache.image_digest(expected)
+
+    # cached color point filters are still folded into one lookup table
+    results = cache.FilterCache()
+    inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
+    scale = lab.color_scale_filter(2, 0.5, 1)
+    expected = scale(inverted(im))
+    assert lab.filter_cascade([results.cached(inverted), results.cached(scale)])(im) == expected
+    lut_filter = lab.make_lut_filter(lab.point_luts(scale.spec), [counted(scale)])
+    assert lut_filter(im) == scale(im)
+    floats = {'height': 1, 'width': 2, 'pixels': [(0.5, 1, 2), (3, 4, 5)]}
+    assert lut_filter(floats) == scale(floats)
+
+    # cached color filters are looked up when run in an ordinary cascade
+    cached_blur = results.cached(lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)))
+    first = lab.filter_cascade([cached_blur])(im)
+    assert (results.hits, results.misses) == (0, 1)
+    assert lab.filter_cascade([cached_blur])(im) == first
+    assert (results.hits, results.misses) == (1, 1)
+
+
+def test_batch_frames_in_order():
+    import batch
+    names = ['centered_pixel_color', 'pattern_color', 'smallfrog', 'smallmushroom']
+    files = []
+    for name in names:
+        with open(os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % name), 'rb') as f:
+            files.append(f.read())
+    frames = list(batch.frames_from_files(files))
+    assert frames[2] == lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    assert list(batch.frames_from_files(files[:1], color=False)) == \
+        [lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel_color.png'))]
+
+    blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(5))
+    cascade = [lab.color_filter_from_greyscale_filter(lab.edges), lab.color_scale_filter(2, 0.3, 1)]
+    expected_blur = [blur(frame) for frame in frames]
+    expected_cascade = [lab.filter_cascade(cascade)(frame) for frame in frames]
+    assert list(batch.process_frames(blur, iter(frames*2), workers=2, max_in_flight=3)) == expected_blur*2
+    results = list(batch.process_frames(cascade, (lab.compact_image(frame) for frame in frames), workers=2))
+    assert all(isinstance(result['pixels'], lab.ColorPixels) for result in results)
+    assert [lab.expand_image(result) for result in results] == expected_cascade
+    assert list(batch.process_frames(blur, frames, workers=1)) == expected_blur
+    assert list(batch.process_frames(lambda im: blur(im), frames, workers=2)) == expected_blur
+
+
+
+def test_benchmarks_and_regressions():
+    import bench
+    image = bench.synthetic_image(0.01, color=True)
+    assert abs(image['width'] * image['height'] - 10000) < 200
+    assert image == bench.synthetic_image(0.01, color=True)
+    cases = bench.benchmark_cases(['edges', 'color_scale'], ['centered_pixel*'], [0.01])
+    assert cases == [('edges', name) for name in ('centered_pixel.png', 'centered_pixel_color.png', 'synthetic_0.01mp')] + \
+        [('color_scale', name) for name in ('centered_pixel.png', 'centered_pixel_color.png', 'synthetic_0.01mp')]
+
+    results = bench.run_benchmarks(cases[-1:], repeat=1, isolate=False)
+    measured = results['results']['color_scale@synthetic_0.01mp']
+    assert measured['megapixels'] == image['width'] * image['height'] / 1e6
+    assert measured['mp_per_s'] > 0
+    assert not bench.find_regressions(results, results)
+    slower = {'results': {key: dict(value, mp_per_s=value['mp_per_s'] / 2)
+                          for key, value in results['results'].items()}}
+    assert bench.find_regressions(slower, results) == \
+        [('color_scale@synthetic_0.01mp', 'mp_per_s', measured['mp_per_s'], measured['mp_per_s'] / 2)]
+
+def test_cascade_splits_color_layers_once(monkeypatch):
+    filters = [lab.color_filter_from_greyscale_filter(lab.edges),
+               lab.color_filter_from_greyscale_filter(lab.inverted),
+               lab.color_scale_filter(2, 0.3, 1),
+               lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))]
+    im = lab.load_color_image('test_images/centered_pixel_color.png')
+    expected = im
+    for filt in filters:
+        expected = filt(expected)
+
+    calls = []
+    split, merge = lab.split_to_grayscale, lab.merge_to_color
+    monkeypatch.setattr(lab, 'split_to_grayscale', lambda image: calls.append('split') or split(image))
+    monkeypatch.setattr(lab, 'merge_to_color', lambda *layers: calls.append('merge') or merge(*layers))
+    result = lab.filter_cascade(filters)(im)
+    assert calls == ['split', 'merge']
+    compare_color_images(result, expected)
+
+
+def test_filter_specs():
+    filters = [lab.inverted, lab.edges, lab.make_blur_filter(3), lab.make_sharpen_filter(5),
+               lab.color_filter_from_greyscale_filter(lab.make_blur_filter(7)),
+               lab.color_scale_filter(2, 0.3, 1)]
+    specs = [filt.spec for filt in filters]
+    assert specs == [('invert',), ('edges',), ('blur', 3), ('sharpen', 5),
+                     ('color', ('blur', 7)), ('color_scale', 2, 0.3, 1)]
+    assert [lab.filter_from_spec(spec).spec for spec in specs] == specs
+    assert not hasattr(lab.color_filter_from_greyscale_filter(lambda im: im), 'spec')
+
+
+def test_optimized_cascade_point_operations():
+    im = lab.load_color_image('test_images/centered_pixel_color.png')
+    color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
+    filters = [lab.color_filter_from_greyscale_filter(lab.edges),
+               color_inverted,
+               lab.color_scale_filter(2, 0.3, 1.7),
+               lab.color_filter_from_greyscale_filter(lab.make_blur_filter(1)),
+               color_inverted,
+               lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3)),
+               color_inverted]
+    assert len(lab.optimize_filters(filters)) == 4
+    expected = im
+    for filt in filters:
+        expected = filt(expected)
+    compare_color_images(lab.filter_cascade(filters)(im), expected)
+
+    # inputs outside [0, 255] fall back to running the filters one by one
+    grey = {'height': 1, 'width': 4, 'pixels': [-3.5, 0, 17.25, 300]}
+    filt = lab.filter_cascade([lab.inverted, lab.inverted])
+    assert filt(grey) == lab.inverted(lab.inverted(grey))
+    assert filt({'height': 1, 'width': 4, 'pixels': [3, 0, 17, 255]})['pixels'] == [3, 0, 17, 255]
+
+
+def test_optimized_cascade_merges_blurs():
+    im = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'))
+    filters = [lab.make_blur_filter(3), lab.make_blur_filter(5), lab.make_blur_filter(2)]
+    assert len(lab.optimize_filters(filters)) == 3
+    optimized = lab.optimize_filters(filters, exact=False)
+    assert len(optimized) == 1 and optimized[0].spec[0] == 'kernel'
+    kernel = optimized[0].spec[1]
+    assert len(kernel) == 8 and sum(map(sum, kernel)) == pytest.approx(1)
+    result = lab.filter_cascade(filters, exact=False)(im)
+    compare_greyscale_images(result, lab.round_and_clip_image(lab.correlate(im, [list(row) for row in kernel], 'extend')))
+    exact = lab.filter_cascade(filters)(im)
+    assert max(abs(a-b) for a, b in zip(result['pixels'], exact['pixels'])) <= 1
+
+
 def test_small_cascade():
     color_edges = lab.color_filter_from_greyscale_filter(lab.edges)
     color_inverted = lab.color_filter_from_greyscale_filter(lab.inverted)
@@ -471,6 +1024,116 @@ def test_cascades(cascade, image):
     compare_color_images(result, expected)
 
 
+
+def test_downsampled_and_preview_specs():
+    im = {'height': 3, 'width': 3, 'pixels': [0, 4, 9,
+                                              2, 6, 1,
+                                              7, 3, 8]}
+    assert lab.downsampled(im) == {'height': 2, 'width': 2, 'pixels': [3, 5, 5, 8]}
+    color = {'height': 1, 'width': 2, 'pixels': [(1, 2, 3), (4, 5, 6)]}
+    assert lab.downsampled(color) == {'height': 1, 'width': 1, 'pixels': [(3, 4, 5)]}
+    assert lab.expand_image(lab.downsampled(lab.compact_image(color))) == lab.downsampled(color)
+    assert lab.downsampled({'height': 1, 'width': 2, 'pixels': [0.5, 1]})['pixels'] == [0.75]
+
+    assert lab.preview_spec(('blur', 9), 1) == ('blur', 5)
+    assert lab.preview_spec(('color', ('sharpen', 3)), 2) == ('color', ('sharpen', 1))
+    assert lab.preview_spec(('blur', 8), 1) == ('blur', 4)
+    assert lab.preview_spec(('gaussian', 6), 1) == ('gaussian', 3)
+    assert lab.preview_spec(('edges',), 3) == ('edges',)
+
+
+def test_image_pyramid_previews(tmp_path):
+    im = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_images', 'smallfrog.png'))
+    blur = lab.color_filter_from_greyscale_filter(lab.make_blur_filter(9))
+    sizes = []
+    def record_size(image):
+        sizes.append((image['width'], image['height']))
+        return image
+
+    pyramid = lab.ImagePyramid(im).filtered(record_size).filtered(blur)
+    assert pyramid.level_size(0) == (im['width'], im['height'])
+    preview = pyramid.preview_for_size(im['width'] // 3, im['height'])
+    assert (preview['width'], preview['height']) == pyramid.level_size(2)
+    assert len(pyramid.levels) == 3 and sizes == [pyramid.level_size(2)]
+    assert preview == lab.color_filter_from_greyscale_filter(lab.make_blur_filter(3))(
+        lab.downsampled(lab.downsampled(im)))
+    assert pyramid.preview(2) is preview and len(sizes) == 1
+
+    # full resolution is computed once, when it is saved
+    outfile = str(tmp_path / 'out.png')
+    pyramid.save(outfile)
+    pyramid.save(outfile)
+    assert sizes == [pyramid.level_size(2), pyramid.level_size(0)]
+    assert lab.load_color_image(outfile) == blur(im)
+
+    grey = lab.load_greyscale_image(os.path.join(TEST_DIRECTORY, 'test_images', 'centered_pixel.png'), compact=True)
+    smallest = lab.downsampled(lab.downsampled(lab.downsampled(lab.downsampled(grey))))
+    assert smallest['width'] == smallest['height'] == 1
+    pyramid = lab.ImagePyramid(grey)
+    assert pyramid.preview_for_size(0, 0) == smallest and len(pyramid.levels) == 5
+
+
+SEAM_IMAGES = {'pattern': 'pattern_color', 'centered_pixel': 'centered_pixel_color',
+               'mushroom': 'smallmushroom'}
+
+
+def load_seam_image(fname):
+    inpfile = os.path.join(TEST_DIRECTORY, 'test_images', '%s.png' % SEAM_IMAGES.get(fname, fname))
+    return lab.load_color_image(inpfile)
+
+
+@pytest.mark.parametrize("fname", ['pattern', 'centered_pixel', 'smallfrog', 'bluegill', 'twocats', 'tree'])
+def test_energy_maps(fname):
+    im = load_seam_image(fname)
+    oim = object_hash(im)
+    energy = lab.compute_energy(lab.greyscale_image_from_color_image(im))
+    with open(os.path.join(TEST_DIRECTORY, 'test_results', '%s_energy.pickle' % fname), 'rb') as f:
+        assert energy == pickle.load(f)
+    cem = lab.cumulative_energy_map(energy)
+    with open(os.path.join(TEST_DIRECTORY, 'test_results', '%s_cumulative_energy.pickle' % fname), 'rb') as f:
+        assert cem == pickle.load(f)
+    seam = lab.minimum_energy_seam(cem)
+    with open(os.path.join(TEST_DIRECTORY, 'test_results', '%s_minimum_energy_seam.pickle' % fname), 'rb') as f:
+        expected = pickle.load(f)
+    assert len(seam) == len(expected) and set(seam) == set(expected)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+
+
+@pytest.mark.parametrize("fname", ['pattern', 'smallfrog', 'bluegill', 'twocats', 'tree'])
+def test_image_without_seam(fname):
+    im = load_seam_image(fname)
+    oim = object_hash(im)
+    with open(os.path.join(TEST_DIRECTORY, 'test_results', '%s_minimum_energy_seam.pickle' % fname), 'rb') as f:
+        seam = pickle.load(f)
+    result = lab.image_without_seam(im, seam)
+    expected = lab.load_color_image(os.path.join(TEST_DIRECTORY, 'test_results', '%s_1seam.png' % fname))
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+    compare_color_images(result, expected)
+
+
+@pytest.mark.parametrize("fname", ['pattern', 'centered_pixel', 'smallfrog', 'mushroom'])
+def test_seam_carving_images(fname):
+    im = load_seam_image(fname)
+    oim = object_hash(im)
+    results = os.path.join(TEST_DIRECTORY, 'test_results', 'seams_%s' % fname)
+    for ncols in range(1, len(os.listdir(results)) + 1):
+        expected = lab.load_color_image(os.path.join(results, '%02d.png' % ncols))
+        compare_color_images(lab.seam_carving(im, ncols), expected)
+    assert object_hash(im) == oim, 'Be careful not to modify the original image!'
+
+
+def test_seam_carving_matches_full_recompute():
+    im = load_seam_image('twocats')
+    expected = im
+    for _ in range(8):
+        grey = lab.greyscale_image_from_color_image(expected)
+        cem = lab.cumulative_energy_map(lab.compute_energy(grey))
+        expected = lab.image_without_seam(expected, lab.minimum_energy_seam(cem))
+    assert lab.seam_carving(im, 8) == expected
+    result = lab.seam_carving(lab.compact_image(im), 8)
+    assert isinstance(result['pixels'], lab.ColorPixels)
+    assert lab.expand_image(result) == expected
+
 if __name__ == '__main__':
     import os
     import sys
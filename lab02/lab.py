@@ -151,23 +151,152 @@ def dump_game(game):
         board.append(row)
     return board
 
-def pare_and_freeze(game):
+def number_cells(game):
     """
-    Extracts the computer locations and player location from the internal
-    game description, freezes the set of computer locations, and returns
-    a tuple containing both, hereby referred to as a "state".
-
-    The value it returns is immutable, thus can be added to the visited_states
-    set.
-
-    For the purposes of checking visited states, the computers and player
-    are the only relevant objects to save since the walls and targets do
-    not move.
+    Numbers the cells of the board that are not walls, so that a set of
+    cells can be represented as an int bitmask (bit i set for cell i).
+
+    Returns a tuple (index, neighbors), where:
+      * index (dict) : maps the (row, col) coordinates of each numbered cell
+        to its number
+      * neighbors (list) : for each direction, in the order of
+        direction_vector, a list giving the number of the cell next to each
+        cell in that direction, or -1 if that is a wall (or off the board)
+    """
+    cells = [(r, c) for r in range(game['rows']) for c in range(game['cols'])
+             if (r, c) not in game['walls']]
+    index = {cell: i for i, cell in enumerate(cells)}
+    neighbors = [[index.get((r + dir_r, c + dir_c), -1) for r, c in cells]
+                 for dir_r, dir_c in direction_vector.values()]
+    return index, neighbors
+
+def cells_mask(locations, index):
+    """
+    Returns the bitmask of the given locations, given a map from coordinates
+    to cell numbers
+    """
+    mask = 0
+    for location in locations:
+        mask |= 1 << index[location]
+    return mask
 
+def dead_cells(neighbors, targets):
+    """
+    Finds the cells from which a computer can never be pushed onto any
+    target, whatever the other computers do.
+
+    Works backwards from the targets: a computer can reach cell y by a push
+    from cell x (next to y) if the player can stand on the far side of x, so
+    pulling computers away from the targets, with the player stepping back
+    in front of them, reaches exactly the cells from which some target is
+    reachable.
+
+    Parameters:
+      * neighbors (list) : the neighbor tables from number_cells
+      * targets (int) : the bitmask of the target cells
+    Returns:
+      The bitmask of every other (dead) cell
+    """
+    live = targets
+    agenda = [cell for cell in range(len(neighbors[0])) if targets >> cell & 1]
+    while agenda:
+        cell = agenda.pop()
+        for neighbor in neighbors:
+            # the computer came from the next cell this way, pushed by a
+            # player standing one cell further on
+            source = neighbor[cell]
+            if source < 0 or live >> source & 1 or neighbor[source] < 0:
+                continue
+            live |= 1 << source
+            agenda.append(source)
+    return ((1 << len(neighbors[0])) - 1) & ~live
+
+def frozen_computers(cell, computers, neighbors, dead, fixed=0):
+    """
+    Checks whether the computer on the given cell can never move again.
+
+    A computer is stuck along an axis (up/down or left/right) if there is a
+    wall on either side of it, if both sides are dead cells (see dead_cells),
+    or if a computer on either side is itself frozen.  That other computer
+    is checked with this one (and any others in `fixed`) treated as a wall,
+    so computers that block each other, such as a 2x2 block or a line along
+    a wall, are found frozen together.  A computer stuck along both axes is
+    frozen.
+
+    Returns:
+      The bitmask of the computers shown to be frozen (including this one),
+      or 0 if this one is not frozen
+    """
+    fixed |= 1 << cell
+    frozen = 1 << cell
+    for first, second in ((neighbors[0], neighbors[1]), (neighbors[2], neighbors[3])):
+        sides = (first[cell], second[cell])
+        if any(side < 0 or fixed >> side & 1 for side in sides):
+            continue
+        if all(dead >> side & 1 for side in sides):
+            continue
+        for side in sides:
+            if computers >> side & 1:
+                blocking = frozen_computers(side, computers, neighbors, dead, fixed)
+                if blocking:
+                    frozen |= blocking
+                    break
+        else:
+            return 0
+    return frozen
+
+def encode_level(game):
     """
-    return (frozenset(game['computers']), game['player'])
+    Prepares a game for the solvers: numbers its cells (see number_cells)
+    and encodes the targets, the computers and the dead cells (see
+    dead_cells) as bitmasks.
+
+    Returns a dictionary containing 'neighbors', 'targets', 'dead',
+    'computers', 'player' (the number of the player's cell) and 'shift' (the
+    number of bits needed for a cell number), or None if the level clearly
+    cannot be solved: a computer starts on a dead cell, or there are not as
+    many computers as targets.
+    """
+    index, neighbors = number_cells(game)
+    if game['player'] not in index or not game['computers'] <= index.keys():
+        return None
+    targets = cells_mask(game['targets'], index)
+    computers = cells_mask(game['computers'], index)
+    # Computers must never be pushed onto cells from which no target can be
+    # reached; every state with such a computer is unsolvable
+    dead = dead_cells(neighbors, targets)
+    if computers & dead or len(game['computers']) != len(game['targets']):
+        return None
+    return {'neighbors': neighbors, 'targets': targets, 'dead': dead,
+            'computers': computers, 'player': index[game['player']],
+            'shift': len(index).bit_length()}
+
+def solution_path(parents, state, neighbors, shift):
+    """
+    Given the parents map built by solve_puzzle and a state in it, returns
+    the list of directions that leads from the initial state to that state.
 
-def solve_puzzle(game):
+    Each state's parent is found by undoing the move recorded for it: the
+    player steps back, pulling the computer in front of it along if the move
+    was a push.
+    """
+    directions = list(direction_vector)
+    player_mask = (1 << shift) - 1
+    path = []
+    while parents[state] is not None:
+        move = parents[state]
+        direction = move & 3
+        player = state & player_mask
+        computers = state >> shift
+        if move & 4:
+            computers ^= (1 << neighbors[direction][player]) | (1 << player)
+        # direction ^ 1 is the opposite direction
+        state = computers << shift | neighbors[direction ^ 1][player]
+        path.append(directions[direction])
+    path.reverse()
+    return path
+
+def solve_puzzle(game, stats=None):
     """
     Given a game representation (of the form returned from new game),
     conducts a Breadth-First Search to find a solution.
@@ -176,56 +305,294 @@ def solve_puzzle(game):
     "down", "left", and "right") needed to reach the victory condition.
 
     If the given level cannot be solved, return None.
-    """
-
-    # Initializes a set containing visited states, an agenda containing
-    # pared game representation paths, and an agenda containing direction paths
 
-    state = pare_and_freeze(game)
-    visited_states = {state}
-
-    state_agenda = [(state,)] # Contains paths of computers-player states
-    direction_agenda = [()] # Contains paths of direction strings
+    States that can never lead to victory are not explored: pushes onto dead
+    cells (see dead_cells), and pushes that leave a frozen computer off its
+    target (see frozen_computers).  If stats is given (a dict), it is filled
+    in with the number of states visited ('states') and the number of pushes
+    discarded by each rule ('dead cells' and 'frozen').
+    """
+    if stats is None:
+        stats = {}
+    stats.update({'states': 0, 'dead cells': 0, 'frozen': 0})
 
     if victory_check(game):
         return []
 
-    while state_agenda:
-
-        # Retrieves the first path on the agenda and gets the terminal vertex
-        # Each vertex is a computers-player state
-        state_path = state_agenda.pop(0)
-        terminal_state = state_path[-1]
-
-        # Also retrieves the corresponding direction path
-        player_path = direction_agenda.pop(0)
-
-        for direction in direction_vector:
-            # Restore terminal state to full game representation
-            terminal_game = {'rows': game['rows'], 'cols': game['cols'],
-                'walls': game['walls'], 'targets': game['targets'],
-                'computers': set(terminal_state[0]), 'player': terminal_state[1]}
-
-            child_game = step_game(terminal_game, direction)
-            child_state = pare_and_freeze(child_game)
-
-            if victory_check(child_game):
-                directions_list = list(player_path)
-                directions_list.append(direction)
-                return directions_list
-
-            if child_state not in visited_states:
+    # The walls and targets never change, so the cells that are not walls
+    # are numbered once.  A state is then a single int: the bitmask of the
+    # computers' cells, shifted left past the number of the player's cell.
+    level = encode_level(game)
+    if level is None:
+        return None
+    neighbors, targets, dead = level['neighbors'], level['targets'], level['dead']
+    shift = level['shift']
+    player_mask = (1 << shift) - 1
+    moves = list(enumerate(neighbors))
+
+    state = level['computers'] << shift | level['player']
+
+    # Maps every state seen so far to the move that first reached it (the
+    # direction's position in direction_vector, plus 4 if it pushed a
+    # computer), or to None for the initial state.  The parent of a state
+    # follows from undoing its move, so each state costs one dict entry and
+    # the path is only rebuilt on victory.
+    parents = {state: None}
+
+    # The search advances one layer (all states at the same depth) at a time,
+    # so the agenda is just the list of states in the current layer
+    layer = [state]
+
+    while layer:
+        next_layer = []
+        for state in layer:
+            player = state & player_mask
+            computers = state >> shift
+            for direction, neighbor in moves:
+                new_player = neighbor[player]
+                if new_player < 0:
+                    continue
+                if computers >> new_player & 1:
+                    # push the computer, unless a wall or another computer is
+                    # behind it
+                    beyond = neighbor[new_player]
+                    if beyond < 0 or computers >> beyond & 1:
+                        continue
+                    if dead >> beyond & 1:
+                        stats['dead cells'] += 1
+                        continue
+                    new_computers = computers ^ (1 << new_player) ^ (1 << beyond)
+                    child = new_computers << shift | new_player
+                    if child in parents:
+                        continue
+                    if new_computers == targets and targets:
+                        parents[child] = direction + 4
+                        stats['states'] = len(parents)
+                        return solution_path(parents, child, neighbors, shift)
+                    if frozen_computers(beyond, new_computers, neighbors, dead) & ~targets:
+                        stats['frozen'] += 1
+                        continue
+                    parents[child] = direction + 4
+                else:
+                    child = state - player + new_player
+                    if child in parents:
+                        continue
+                    parents[child] = direction
+                next_layer.append(child)
+        layer = next_layer
+
+    stats['states'] = len(parents)
+    return None
 
-                # Appends a new path containing the old path + child vertex
-                # to the agenda
-                child_state_path = state_path + (child_state,)
-                state_agenda.append(child_state_path)
 
-                child_player_path = player_path + (direction,)
-                direction_agenda.append(child_player_path)
+def walking_distances(player, computers, neighbors):
+    """
+    Finds every cell the player can walk to without pushing a computer.
 
-                visited_states.add(child_state)
+    Returns a dictionary mapping each of those cells to the number of steps
+    needed to reach it from the player's cell
+    """
+    distances = {player: 0}
+    layer = [player]
+    steps = 0
+    while layer:
+        steps += 1
+        next_layer = []
+        for cell in layer:
+            for neighbor in neighbors:
+                new_cell = neighbor[cell]
+                if (new_cell >= 0 and not computers >> new_cell & 1
+                        and new_cell not in distances):
+                    distances[new_cell] = steps
+                    next_layer.append(new_cell)
+        layer = next_layer
+    return distances
+
+def walking_path(player, goal, computers, neighbors):
+    """
+    Returns a shortest list of directions along which the player walks from
+    its cell to the goal cell without pushing a computer
+    """
+    directions = list(direction_vector)
+    parents = {player: None}
+    layer = [player]
+    while goal not in parents:
+        next_layer = []
+        for cell in layer:
+            for direction, neighbor in enumerate(neighbors):
+                new_cell = neighbor[cell]
+                if (new_cell >= 0 and not computers >> new_cell & 1
+                        and new_cell not in parents):
+                    parents[new_cell] = (cell, direction)
+                    next_layer.append(new_cell)
+        layer = next_layer
+    path = []
+    while parents[goal] is not None:
+        goal, direction = parents[goal]
+        path.append(directions[direction])
+    path.reverse()
+    return path
+
+def legal_pushes(distances, computers, level, stats, deadlocks):
+    """
+    Given the cells the player can walk to (see walking_distances), yields a
+    tuple (cell, direction, new_computers) for every push the player can make
+    from one of them (standing on cell, pushing in the given direction) that
+    could still lead to victory.  Pushes onto dead cells and pushes that
+    leave a frozen computer off its target are counted in stats and skipped.
+
+    The same arrangement of computers is often reached by many pushes, so
+    the result of each freeze check is remembered in the dict deadlocks.
+    """
+    neighbors, targets, dead = level['neighbors'], level['targets'], level['dead']
+    remaining = computers
+    while remaining:
+        # the lowest computer left, and the cell it is on
+        lowest = remaining & -remaining
+        remaining ^= lowest
+        computer = lowest.bit_length() - 1
+        for direction, neighbor in enumerate(neighbors):
+            # direction ^ 1 is the opposite direction
+            cell = neighbors[direction ^ 1][computer]
+            if cell not in distances:
+                continue
+            beyond = neighbor[computer]
+            if beyond < 0 or computers >> beyond & 1:
+                continue
+            if dead >> beyond & 1:
+                stats['dead cells'] += 1
+                continue
+            new_computers = computers ^ (1 << computer) ^ (1 << beyond)
+            key = (new_computers, beyond)
+            if key not in deadlocks:
+                deadlocks[key] = bool(
+                    new_computers != targets and
+                    frozen_computers(beyond, new_computers, neighbors, dead) & ~targets)
+            if deadlocks[key]:
+                stats['frozen'] += 1
+                continue
+            yield cell, direction, new_computers
+
+def push_solution_path(parents, state, level):
+    """
+    Given the parents map built by solve_puzzle_by_pushes and a state in it,
+    returns the list of directions that leads from the initial state to that
+    state: the pushes are replayed from the start, with the player walking
+    along a shortest path to each push.
+    """
+    pushes = []
+    while parents[state] is not None:
+        state, cell, direction = parents[state]
+        pushes.append((cell, direction))
+    pushes.reverse()
+
+    neighbors = level['neighbors']
+    directions = list(direction_vector)
+    player, computers = level['player'], level['computers']
+    path = []
+    for cell, direction in pushes:
+        path.extend(walking_path(player, cell, computers, neighbors))
+        path.append(directions[direction])
+        player = neighbors[direction][cell]
+        computers ^= (1 << player) | (1 << neighbors[direction][player])
+    return path
+
+def solve_puzzle_by_pushes(game, fewest_pushes=False, stats=None):
+    """
+    Given a game representation (of the form returned from new game), finds
+    a solution by searching over pushes rather than single steps: between
+    two pushes the player can walk anywhere in the region it can reach, so
+    each state only records the computers and where in its region the player
+    is, and its children are the legal pushes from anywhere in the region
+    (see legal_pushes).  The walking moves are only filled in for the
+    solution that is found.
+
+    By default, returns a shortest list of moves, like solve_puzzle.  The
+    player's exact cell then matters, but after a push it is always the cell
+    the pushed computer left, so states are few.  The states are expanded in
+    order of the number of moves that reach them (Dijkstra's algorithm, with
+    one bucket of states per number of moves).
+
+    If fewest_pushes is True, returns a list of moves with the fewest
+    possible pushes (but not necessarily the fewest moves).  The player's
+    cell is then replaced by the lowest numbered cell of its region, so all
+    of the states that differ only by where the player stands in the same
+    region are one state, and the search is a breadth-first search over
+    pushes.
+
+    Returns None if the level cannot be solved.  stats is filled in as by
+    solve_puzzle.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({'states': 0, 'dead cells': 0, 'frozen': 0})
 
+    if victory_check(game):
+        return []
+    level = encode_level(game)
+    if level is None:
+        return None
+    neighbors, targets, shift = level['neighbors'], level['targets'], level['shift']
+    player_mask = (1 << shift) - 1
+    deadlocks = {}
+
+    if fewest_pushes:
+        distances = walking_distances(level['player'], level['computers'], neighbors)
+        state = level['computers'] << shift | min(distances)
+        # Maps every state seen so far to (parent state, cell the player
+        # pushed from, direction), or to None for the initial state
+        parents = {state: None}
+        layer = [state]
+        while layer:
+            next_layer = []
+            for state in layer:
+                computers = state >> shift
+                distances = walking_distances(state & player_mask, computers, neighbors)
+                for cell, direction, new_computers in legal_pushes(
+                        distances, computers, level, stats, deadlocks):
+                    player = neighbors[direction][cell]
+                    region = walking_distances(player, new_computers, neighbors)
+                    child = new_computers << shift | min(region)
+                    if child in parents:
+                        continue
+                    parents[child] = (state, cell, direction)
+                    if new_computers == targets:
+                        stats['states'] = len(parents)
+                        return push_solution_path(parents, child, level)
+                    next_layer.append(child)
+            layer = next_layer
+        stats['states'] = len(parents)
+        return None
+
+    state = level['computers'] << shift | level['player']
+    parents = {state: None}
+    # the fewest moves found so far to reach each state
+    moves = {state: 0}
+    # buckets[n] holds the states first reached with n moves
+    buckets = [[state]]
+    for cost, bucket in enumerate(buckets):
+        for state in bucket:
+            if moves[state] != cost:
+                # reached with fewer moves since it was added to this bucket
+                continue
+            computers = state >> shift
+            if computers == targets:
+                stats['states'] = len(parents)
+                return push_solution_path(parents, state, level)
+            distances = walking_distances(state & player_mask, computers, neighbors)
+            for cell, direction, new_computers in legal_pushes(
+                    distances, computers, level, stats, deadlocks):
+                child = new_computers << shift | neighbors[direction][cell]
+                child_cost = cost + distances[cell] + 1
+                if moves.get(child, child_cost + 1) <= child_cost:
+                    continue
+                moves[child] = child_cost
+                parents[child] = (state, cell, direction)
+                while len(buckets) <= child_cost:
+                    buckets.append([])
+                buckets[child_cost].append(child)
+        buckets[cost] = None
+    stats['states'] = len(parents)
     return None
 
 
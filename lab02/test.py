@@ -130,6 +130,84 @@ def test_solver(test_group):
             compare_solution(puzzle, result)
 
 
+def test_solver_dead_cells():
+    level = [[['wall']]*6,
+             [['wall'], [], [], [], ['target'], ['wall']],
+             [['wall'], ['player'], ['computer'], ['computer'], ['target'], ['wall']],
+             [['wall'], [], ['computer'], ['computer'], ['target'], ['wall']],
+             [['wall'], [], [], [], ['target'], ['wall']],
+             [['wall']]*6]
+    game = lab.new_game(level)
+    index, neighbors = lab.number_cells(game)
+    dead = lab.dead_cells(neighbors, lab.cells_mask(game['targets'], index))
+    # a computer against the left wall can never be pushed right, towards
+    # the targets; every other cell can reach one
+    assert dead == lab.cells_mask({(1, 1), (2, 1), (3, 1), (4, 1)}, index)
+    assert lab.encode_level(game)['dead'] == dead
+
+    # with two targets, a computer starting on a dead cell or a third
+    # computer makes the level unsolvable before any search
+    for start in ([(2, 2), (1, 1)], [(2, 2), (3, 3), (2, 3)]):
+        changed = [[[obj for obj in cell if obj != 'computer'] for cell in row]
+                   for row in level]
+        for r, c in start:
+            changed[r][c].append('computer')
+        changed[3][4] = changed[4][4] = []
+        game = lab.new_game(changed)
+        assert lab.encode_level(game) is None
+        stats = {}
+        assert lab.solve_puzzle(game, stats) is None and stats['states'] == 0
+        assert lab.solve_puzzle_by_pushes(game) is None
+
+def test_solver_deadlock_pruning():
+    # a 2x2 block of computers off the targets can never be broken up
+    level = [[['wall']]*6,
+             [['wall'], [], [], [], ['target'], ['wall']],
+             [['wall'], ['player'], ['computer'], ['computer'], ['target'], ['wall']],
+             [['wall'], [], ['computer'], ['computer'], ['target'], ['wall']],
+             [['wall'], [], [], [], ['target'], ['wall']],
+             [['wall']]*6]
+    game = lab.new_game(level)
+    index, neighbors = lab.number_cells(game)
+    targets = lab.cells_mask(game['targets'], index)
+    computers = lab.cells_mask(game['computers'], index)
+    dead = lab.dead_cells(neighbors, targets)
+    assert lab.frozen_computers(index[(2, 2)], computers, neighbors, dead) == computers
+    assert lab.frozen_computers(index[(2, 2)], 1 << index[(2, 2)], neighbors, dead) == 0
+
+    stats = {}
+    assert lab.solve_puzzle(game, stats) is None
+    assert stats['states'] > 0
+
+    with open(os.path.join(TEST_DIRECTORY, "puzzles", "m2_089.json")) as f:
+        game = lab.new_game(json.load(f))
+    assert len(lab.solve_puzzle(game, stats)) == 67
+    assert stats['frozen'] > 0
+
+def count_pushes(game, solution):
+    pushes = 0
+    for direction in solution:
+        new = lab.step_game(game, direction)
+        pushes += new['computers'] != game['computers']
+        game = new
+    return pushes
+
+
+@pytest.mark.parametrize('test_group', list(SOLVER_TEST_GROUPS))
+def test_solver_by_pushes(test_group):
+    for puzzle, elen in zip(SOLVER_TEST_GROUPS[test_group], SOLUTION_LENGTHS[test_group]):
+        with open(os.path.join(TEST_DIRECTORY, "puzzles", f"{puzzle}.json")) as f:
+            game = lab.new_game(json.load(f))
+        result = lab.solve_puzzle_by_pushes(game)
+        fewest = lab.solve_puzzle_by_pushes(game, fewest_pushes=True)
+        if elen is None:
+            assert result is None and fewest is None
+            continue
+        assert len(result) == elen, f"Expected a solution of length {elen} for {puzzle}, got {len(result)}."
+        compare_solution(puzzle, result)
+        compare_solution(puzzle, fewest)
+        assert count_pushes(game, fewest) <= count_pushes(game, result)
+
 if __name__ == "__main__":
     import os
     import sys